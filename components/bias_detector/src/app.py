@@ -19,32 +19,44 @@ import argparse
 import pandas as pd
 from minio import Minio
 import json
-import zipfile
-import importlib
 import re
 
-import torch
-import torch.utils.data
-from torch.autograd import Variable
-
 from flask import Flask, request, abort
 from flask_cors import CORS
 
+import artifact_cache
+import model_registry
+import prediction_cache
+import sharded_dataset
+from fairness_metrics import bootstrap_confidence_intervals, fairness_counts, fairness_metrics, group_fairness_table
+from jobs import JobQueue
+
 app = Flask(__name__)
 CORS(app)
 
-def dataset_wrapper(outcome, protected, unprivileged_groups, privileged_groups, favorable_label, unfavorable_label):
+# Bounded pool running POST /jobs submissions, sized by JOB_CONCURRENCY.
+job_queue = JobQueue()
+
+# Optional fairness_check arguments accepted by POST /jobs.
+JOB_PARAMETERS = ('feature_testset_path', 'label_testset_path', 'protected_label_testset_path',
+                  'model_class_file', 'model_class_name', 'favorable_label', 'unfavorable_label',
+                  'privileged_groups', 'unprivileged_groups', 'engine', 'protected_attribute_name',
+                  'protected_testset_paths', 'group_definitions', 'intersections', 'bootstrap_resamples',
+                  'confidence_level')
+
+def dataset_wrapper(outcome, protected, unprivileged_groups, privileged_groups, favorable_label, unfavorable_label,
+                    protected_attribute_name='race'):
     """ A wrapper function to create aif360 dataset from outcome and protected in numpy array format.
     """
     df = pd.DataFrame(data=outcome,
                       columns=['outcome'])
-    df['race'] = protected
+    df[protected_attribute_name] = protected
 
     dataset = BinaryLabelDataset(favorable_label=favorable_label,
                                  unfavorable_label=unfavorable_label,
                                  df=df,
                                  label_names=['outcome'],
-                                 protected_attribute_names=['race'],
+                                 protected_attribute_names=[protected_attribute_name],
                                  unprivileged_protected_attributes=unprivileged_groups)
     return dataset
 
@@ -57,27 +69,41 @@ def get_s3_item(client, bucket, s3_path, name):
         else:
             raise
 
-# Compute the accuaracy and predicted label using the given test dataset
-def evaluate(model, X_test, y_test):
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    test = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_test.astype('float32'))), Variable(torch.LongTensor(y_test.astype('float32'))))
-    test_loader = torch.utils.data.DataLoader(test, batch_size=64, shuffle=False)
-    model.eval()
-    correct = 0
-    accuracy = 0
-    y_pred = []
-    with torch.no_grad():
-        for images, labels in test_loader:
-            images = images.to(device)
-            labels = labels.to(device)
-            outputs = model(images)
-            _, predicted = torch.max(outputs.data, 1)
-            predictions = torch.softmax(outputs.data, dim=1).detach().numpy()
-            correct += predicted.eq(labels.data.view_as(predicted)).sum().item()
-            y_pred += predicted.tolist()
-        accuracy = 1. * correct / len(test_loader.dataset)
-    y_pred = np.array(y_pred)
-    return accuracy, y_pred
+def aif360_metrics(y_test, y_pred, p_test, privileged_groups, unprivileged_groups, favorable_label, unfavorable_label,
+                   protected_attribute_name='race'):
+    """ The fairness report computed with aif360's ClassificationMetric. """
+    original_test_dataset = dataset_wrapper(outcome=y_test, protected=p_test,
+                                            unprivileged_groups=unprivileged_groups,
+                                            privileged_groups=privileged_groups,
+                                            favorable_label=favorable_label,
+                                            unfavorable_label=unfavorable_label,
+                                            protected_attribute_name=protected_attribute_name)
+    plain_predictions_test_dataset = dataset_wrapper(outcome=y_pred, protected=p_test,
+                                                     unprivileged_groups=unprivileged_groups,
+                                                     privileged_groups=privileged_groups,
+                                                     favorable_label=favorable_label,
+                                                     unfavorable_label=unfavorable_label,
+                                                     protected_attribute_name=protected_attribute_name)
+
+    classified_metric_nodebiasing_test = ClassificationMetric(original_test_dataset,
+                                                              plain_predictions_test_dataset,
+                                                              unprivileged_groups=unprivileged_groups,
+                                                              privileged_groups=privileged_groups)
+    TPR = classified_metric_nodebiasing_test.true_positive_rate()
+    TNR = classified_metric_nodebiasing_test.true_negative_rate()
+    bal_acc_nodebiasing_test = 0.5*(TPR+TNR)
+
+    metrics = {
+        "Classification accuracy": classified_metric_nodebiasing_test.accuracy(),
+        "Balanced classification accuracy": bal_acc_nodebiasing_test,
+        "Statistical parity difference": classified_metric_nodebiasing_test.statistical_parity_difference(),
+        "Disparate impact": classified_metric_nodebiasing_test.disparate_impact(),
+        "Equal opportunity difference": classified_metric_nodebiasing_test.equal_opportunity_difference(),
+        "Average odds difference": classified_metric_nodebiasing_test.average_odds_difference(),
+        "Theil index": classified_metric_nodebiasing_test.theil_index(),
+        "False negative rate difference": classified_metric_nodebiasing_test.false_negative_rate_difference()
+    }
+    return metrics
 
 
 def fairness_check(object_storage_url, object_storage_username, object_storage_password,
@@ -90,84 +116,107 @@ def fairness_check(object_storage_url, object_storage_username, object_storage_p
                    favorable_label=0.0,
                    unfavorable_label=1.0,
                    privileged_groups=[{'race': 0.0}],
-                   unprivileged_groups=[{'race': 4.0}]):
+                   unprivileged_groups=[{'race': 4.0}],
+                   engine='native',
+                   protected_attribute_name='race',
+                   protected_testset_paths=None,
+                   group_definitions=None,
+                   intersections=None,
+                   bootstrap_resamples=0,
+                   confidence_level=0.95,
+                   progress=None):
+    """
+    Predict the test set with the trained model and report its fairness
+    metrics. engine selects between the vectorized fairness_metrics module
+    ('native') and aif360's ClassificationMetric ('aif360'); both produce the
+    same report.
 
+    The protected attribute in protected_label_testset_path is named
+    protected_attribute_name. protected_testset_paths maps further attribute
+    names to their test set paths in the data bucket. When group_definitions
+    (group name -> list of {attribute: value} dicts) or intersections (lists
+    of attribute names) are given, the report also holds a "Group metrics"
+    table that compares every group with privileged_groups, computed from
+    the same predictions.
+
+    With bootstrap_resamples > 0 the report also holds "Confidence
+    intervals": percentile bootstrap intervals at confidence_level for every
+    fairness metric, whichever engine computed the point estimates.
+    """
+
+    if progress:
+        progress('loading')
     url = re.compile(r"https?://")
     cos = Minio(url.sub('', object_storage_url),
                 access_key=object_storage_username,
                 secret_key=object_storage_password)
 
-    dataset_filenamex = "X_test.npy"
-    dataset_filenamey = "y_test.npy"
-    dataset_filenamep = "p_test.npy"
-    weights_filename = "model.pt"
-    model_files = model_id + '/_submitted_code/model.zip'
-
-    cos.fget_object(data_bucket_name, feature_testset_path, dataset_filenamex)
-    cos.fget_object(data_bucket_name, label_testset_path, dataset_filenamey)
-    cos.fget_object(data_bucket_name, protected_label_testset_path, dataset_filenamep)
-    cos.fget_object(result_bucket_name, model_id + '/' + weights_filename, weights_filename)
-    cos.fget_object(result_bucket_name, model_files, 'model.zip')
-
-    # Load PyTorch model definition from the source code.
-    zip_ref = zipfile.ZipFile('model.zip', 'r')
-    zip_ref.extractall('model_files')
-    zip_ref.close()
-
-    modulename = 'model_files.' + model_class_file.split('.')[0].replace('-', '_')
-
-    '''
-    We required users to define where the model class is located or follow
-    some naming convention we have provided.
-    '''
-    model_class = getattr(importlib.import_module(modulename), model_class_name)
-
-    # load & compile model
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    model = model_class().to(device)
-    model.load_state_dict(torch.load(weights_filename, map_location=device))
+    protected_testset_paths = protected_testset_paths or {}
+    attribute_names = list(protected_testset_paths)
+    paths = artifact_cache.fetch_all(cos, [
+        (data_bucket_name, label_testset_path),
+        (data_bucket_name, protected_label_testset_path)
+    ] + [(data_bucket_name, protected_testset_paths[name]) for name in attribute_names])
+    dataset_filenamey, dataset_filenamep = paths[:2]
 
     """Load the necessary labels and protected features for fairness check"""
 
-    x_test = np.load(dataset_filenamex)
     y_test = np.load(dataset_filenamey)
     p_test = np.load(dataset_filenamep)
+    protected = {protected_attribute_name: p_test}
+    for name, path in zip(attribute_names, paths[2:]):
+        protected[name] = np.load(path)
+
+    def load_x_test():
+        # only called when no predictions of this model on this test set are stored
+        if sharded_dataset.is_sharded(feature_testset_path):
+            # stream the shards of a sharded dataset, decoding one batch at a time
+            return sharded_dataset.open_sharded_object(cos, data_bucket_name, feature_testset_path,
+                                                       artifact_cache.fetch)
+        return np.load(artifact_cache.fetch(cos, data_bucket_name, feature_testset_path))
 
-    _, y_pred = evaluate(model, x_test, y_test)
+    if progress:
+        progress('predicting', 0.0)
+    # Reuse the predictions of an earlier check of this model on this test
+    # set. Otherwise the registry only downloads, imports and loads the model
+    # on first use.
+    _, softmax = prediction_cache.get_predictions(
+        cos, data_bucket_name, result_bucket_name, model_id, feature_testset_path, load_x_test,
+        lambda: model_registry.default_registry().get(cos, result_bucket_name, model_id,
+                                                      model_class_file=model_class_file,
+                                                      model_class_name=model_class_name),
+        model_class_file=model_class_file, model_class_name=model_class_name)
+    y_pred = np.argmax(softmax, axis=1)
 
     """Calculate the fairness metrics"""
+    if progress:
+        progress('computing metrics', 0.5)
 
-    original_test_dataset = dataset_wrapper(outcome=y_test, protected=p_test,
-                                            unprivileged_groups=unprivileged_groups,
-                                            privileged_groups=privileged_groups,
-                                            favorable_label=favorable_label,
-                                            unfavorable_label=unfavorable_label)
-    plain_predictions_test_dataset = dataset_wrapper(outcome=y_pred, protected=p_test,
-                                                     unprivileged_groups=unprivileged_groups,
-                                                     privileged_groups=privileged_groups,
-                                                     favorable_label=favorable_label,
-                                                     unfavorable_label=unfavorable_label)
+    print("#### Plain model - without debiasing - classification metrics on test set")
 
-    classified_metric_nodebiasing_test = ClassificationMetric(original_test_dataset,
-                                                              plain_predictions_test_dataset,
-                                                              unprivileged_groups=unprivileged_groups,
-                                                              privileged_groups=privileged_groups)
-    TPR = classified_metric_nodebiasing_test.true_positive_rate()
-    TNR = classified_metric_nodebiasing_test.true_negative_rate()
-    bal_acc_nodebiasing_test = 0.5*(TPR+TNR)
+    if engine == 'aif360':
+        metrics = aif360_metrics(y_test, y_pred, p_test,
+                                 privileged_groups=privileged_groups,
+                                 unprivileged_groups=unprivileged_groups,
+                                 favorable_label=favorable_label,
+                                 unfavorable_label=unfavorable_label,
+                                 protected_attribute_name=protected_attribute_name)
+    else:
+        metrics = fairness_metrics(y_test, y_pred, protected,
+                                   privileged_groups=privileged_groups,
+                                   unprivileged_groups=unprivileged_groups,
+                                   favorable_label=favorable_label)
 
-    print("#### Plain model - without debiasing - classification metrics on test set")
+    if bootstrap_resamples:
+        counts = fairness_counts(y_test, y_pred, protected, privileged_groups, unprivileged_groups, favorable_label)
+        metrics["Confidence intervals"] = bootstrap_confidence_intervals(counts, bootstrap_resamples, confidence_level)
+        metrics["Confidence level"] = confidence_level
 
-    metrics = {
-        "Classification accuracy": classified_metric_nodebiasing_test.accuracy(),
-        "Balanced classification accuracy": bal_acc_nodebiasing_test,
-        "Statistical parity difference": classified_metric_nodebiasing_test.statistical_parity_difference(),
-        "Disparate impact": classified_metric_nodebiasing_test.disparate_impact(),
-        "Equal opportunity difference": classified_metric_nodebiasing_test.equal_opportunity_difference(),
-        "Average odds difference": classified_metric_nodebiasing_test.average_odds_difference(),
-        "Theil index": classified_metric_nodebiasing_test.theil_index(),
-        "False negative rate difference": classified_metric_nodebiasing_test.false_negative_rate_difference()
-    }
+    if group_definitions or intersections:
+        metrics["Group metrics"] = group_fairness_table(y_test, y_pred, protected, privileged_groups,
+                                                        definitions=group_definitions,
+                                                        intersections=intersections,
+                                                        favorable_label=favorable_label)
     print("metrics: ", metrics)
     return metrics
 
@@ -194,5 +243,33 @@ def fairness_api_options():
     return "200"
 
 
+@app.route('/jobs', methods=['POST'])
+def fairness_job_api():
+    try:
+        params = {
+            "object_storage_url": request.json['aws_endpoint_url'],
+            "result_bucket_name": request.json['training_results_bucket'],
+            "object_storage_username": request.json['aws_access_key_id'],
+            "object_storage_password": request.json['aws_secret_access_key'],
+            "model_id": request.json['model_id'],
+            "data_bucket_name": request.json['training_data_bucket']
+        }
+        for name in JOB_PARAMETERS:
+            if name in request.json:
+                params[name] = request.json[name]
+    except:
+        abort(400)
+    job = job_queue.submit(fairness_check, params)
+    return json.dumps({"job_id": job.id, "status": job.status}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def fairness_job_status_api(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return json.dumps(job.to_dict())
+
+
 if __name__ == "__main__":
     app.run(debug=True,host='0.0.0.0',port=int(os.environ.get('PORT', 8080)))
@@ -12,22 +12,53 @@
 # See the License for the specific language governing permissions and 
 # limitations under the License. 
 import json
+import math
 import argparse
 
 from app import fairness_check
 
 
-def check_fairness(metrics):
-    if abs(metrics['Statistical parity difference']) > 0.1:
-        return False
-    if abs(metrics['Disparate impact']) < 0.8:
-        return False
-    if abs(metrics['Equal opportunity difference']) > 0.1:
-        return False
-    if abs(metrics['Average odds difference']) > 0.1:
+DIFFERENCE_METRICS = ('Statistical parity difference', 'Equal opportunity difference',
+                      'Average odds difference', 'False negative rate difference')
+
+
+def check_fairness(metrics, ci_gate='none'):
+    """
+    Gate on the point estimates, or with bootstrap confidence intervals in
+    the metrics, on the interval bounds: ci_gate 'lenient' only fails a
+    metric when its whole interval violates the threshold, 'strict' fails it
+    when any part of the interval does. A non-finite bound, e.g. from a
+    group with no samples in some resamples, always fails the metric.
+    """
+    if ci_gate == 'none' or 'Confidence intervals' not in metrics:
+        if abs(metrics['Statistical parity difference']) > 0.1:
+            return False
+        if abs(metrics['Disparate impact']) < 0.8:
+            return False
+        if abs(metrics['Equal opportunity difference']) > 0.1:
+            return False
+        if abs(metrics['Average odds difference']) > 0.1:
+            return False
+        if abs(metrics['False negative rate difference']) > 0.1:
+            return False
+        return True
+
+    intervals = metrics['Confidence intervals']
+    lower, upper = intervals['Disparate impact']
+    if not (math.isfinite(lower) and math.isfinite(upper)):
         return False
-    if abs(metrics['False negative rate difference']) > 0.1:
+    if (upper if ci_gate == 'lenient' else lower) < 0.8:
         return False
+    for name in DIFFERENCE_METRICS:
+        lower, upper = intervals[name]
+        if not (math.isfinite(lower) and math.isfinite(upper)):
+            return False
+        if ci_gate == 'lenient':
+            violated = lower > 0.1 or upper < -0.1
+        else:
+            violated = upper > 0.1 or lower < -0.1
+        if violated:
+            return False
     return True
 
 def get_secret(path):
@@ -45,13 +76,21 @@ if __name__ == "__main__":
     parser.add_argument('--fairness_status', type=str, help='Path for fairness status output', default="/tmp/status.txt")
     parser.add_argument('--model_class_file', type=str, help='pytorch model class file', default="model.py")
     parser.add_argument('--model_class_name', type=str, help='pytorch model class name', default="model")
-    parser.add_argument('--feature_testset_path', type=str, help='Feature test dataset path in the data bucket', default="processed_data/X_test.npy")
+    parser.add_argument('--feature_testset_path', type=str, help='Feature test dataset path in the data bucket, a .npy file or the index.json of a sharded dataset', default="processed_data/X_test.npy")
     parser.add_argument('--label_testset_path', type=str, help='Label test dataset path in the data bucket', default="processed_data/y_test.npy")
     parser.add_argument('--protected_label_testset_path', type=str, help='Protected label test dataset path in the data bucket', default="processed_data/p_test.npy")
     parser.add_argument('--favorable_label', type=float, help='Favorable label for this model predictions', default=0.0)
     parser.add_argument('--unfavorable_label', type=float, help='Unfavorable label for this model predictions', default=1.0)
     parser.add_argument('--privileged_groups', type=str, help='Privileged feature groups within this model', default="[{'race': 0.0}]")
     parser.add_argument('--unprivileged_groups', type=str, help='Unprivileged feature groups within this model', default="[{'race': 4.0}]")
+    parser.add_argument('--protected_attribute_name', type=str, help='Name of the protected attribute stored at protected_label_testset_path', default="race")
+    parser.add_argument('--protected_testset_paths', type=str, help='Further protected attributes, as a dict of attribute name to test dataset path in the data bucket', default="{}")
+    parser.add_argument('--group_definitions', type=str, help='Groups to report metrics for, as a dict of group name to a list of {attribute: value} dicts', default="{}")
+    parser.add_argument('--intersections', type=str, help='Lists of protected attribute names whose value combinations are reported as groups', default="[]")
+    parser.add_argument('--engine', type=str, help='Fairness metrics implementation, native or aif360', choices=['native', 'aif360'], default="native")
+    parser.add_argument('--bootstrap_resamples', type=int, help='Number of bootstrap resamples for metric confidence intervals (0 disables them)', default=0)
+    parser.add_argument('--ci_gate', type=str, help='Decide the fairness status on the point estimates (none) or on the confidence interval bounds (lenient, strict)', choices=['none', 'lenient', 'strict'], default="none")
+    parser.add_argument('--confidence_level', type=float, help='Confidence level of the bootstrap intervals', default=0.95)
 
     object_storage_url = get_secret('/app/secrets/s3_url')
     data_bucket_name = get_secret('/app/secrets/training_bucket')
@@ -72,6 +111,14 @@ if __name__ == "__main__":
     unfavorable_label = args.unfavorable_label
     privileged_groups = eval(args.privileged_groups)
     unprivileged_groups = eval(args.unprivileged_groups)
+    engine = args.engine
+    protected_attribute_name = args.protected_attribute_name
+    protected_testset_paths = eval(args.protected_testset_paths)
+    group_definitions = eval(args.group_definitions)
+    intersections = eval(args.intersections)
+    bootstrap_resamples = args.bootstrap_resamples
+    ci_gate = args.ci_gate
+    confidence_level = args.confidence_level
 
     metrics = fairness_check(object_storage_url, object_storage_username, object_storage_password,
                                data_bucket_name, result_bucket_name, model_id,
@@ -83,7 +130,21 @@ if __name__ == "__main__":
                                favorable_label=favorable_label,
                                unfavorable_label=unfavorable_label,
                                privileged_groups=privileged_groups,
-                               unprivileged_groups=unprivileged_groups)
+                               unprivileged_groups=unprivileged_groups,
+                               engine=engine,
+                               protected_attribute_name=protected_attribute_name,
+                               protected_testset_paths=protected_testset_paths,
+                               group_definitions=group_definitions,
+                               intersections=intersections,
+                               bootstrap_resamples=bootstrap_resamples,
+                               confidence_level=confidence_level)
 
     with open(metric_path, "w") as report:
         report.write(json.dumps(metrics))
+
+    fair = "true"
+    if not check_fairness(metrics, ci_gate):
+        fair = "false"
+
+    with open(fairness_status, "w") as report:
+        report.write(fair)
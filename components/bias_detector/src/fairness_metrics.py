@@ -0,0 +1,242 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Vectorized fairness metrics computed from per-group confusion counts. """
+import numpy as np
+
+UNPRIVILEGED = 0
+PRIVILEGED = 1
+OTHER = 2
+
+
+def group_membership(protected, groups):
+    """
+    Boolean mask of the rows matching any of the group definitions, in the
+    aif360 format: a list of {attribute: value} dicts, where the conditions of
+    one dict must all hold. protected maps attribute names to numpy arrays.
+    """
+    n = len(next(iter(protected.values())))
+    mask = np.zeros(n, dtype=bool)
+    for group in groups:
+        condition = np.ones(n, dtype=bool)
+        for attribute, value in group.items():
+            condition &= (protected[attribute] == value)
+        mask |= condition
+    return mask
+
+
+def group_index(protected, privileged_groups, unprivileged_groups):
+    """ Code every row as UNPRIVILEGED, PRIVILEGED or OTHER. """
+    index = np.full(len(next(iter(protected.values()))), OTHER, dtype=np.int64)
+    index[group_membership(protected, unprivileged_groups)] = UNPRIVILEGED
+    index[group_membership(protected, privileged_groups)] = PRIVILEGED
+    return index
+
+
+def confusion_counts(y_true, y_pred, group, n_groups, favorable_label):
+    """
+    Count every (group, true label, predicted label) combination in a single
+    bincount. Returns an array of shape (n_groups, 2, 2) indexed by
+    [group, label is favorable, prediction is favorable].
+    """
+    truth = (np.asarray(y_true).ravel() == favorable_label).astype(np.int64)
+    prediction = (np.asarray(y_pred).ravel() == favorable_label).astype(np.int64)
+    cell = np.asarray(group).ravel() * 4 + truth * 2 + prediction
+    return np.bincount(cell, minlength=n_groups * 4).reshape(n_groups, 2, 2)
+
+
+def _divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.float64(numerator) / np.float64(denominator)
+
+
+def rates(counts):
+    """
+    Rates of confusion count matrices of shape (..., 2, 2), favorable label as
+    positive. Works on a single matrix or on a stack of per-group matrices.
+    """
+    tn, fp = counts[..., 0, 0], counts[..., 0, 1]
+    fn, tp = counts[..., 1, 0], counts[..., 1, 1]
+    total = counts.sum(axis=(-2, -1))
+    return {
+        "TPR": _divide(tp, tp + fn),
+        "TNR": _divide(tn, tn + fp),
+        "FPR": _divide(fp, tn + fp),
+        "FNR": _divide(fn, tp + fn),
+        "selection_rate": _divide(tp + fp, total),
+        "accuracy": _divide(tp + tn, total)
+    }
+
+
+def theil_index(counts):
+    """
+    Theil index of the benefits b = 1 + y_pred - y_true. b only takes the
+    values 0 (false negative), 1 (correct) and 2 (false positive), so the
+    index follows from the confusion counts (of shape (..., 2, 2)).
+    """
+    tn, fp = counts[..., 0, 0], counts[..., 0, 1]
+    tp = counts[..., 1, 1]
+    n = counts.sum(axis=(-2, -1))
+    mu = _divide(tp + tn + 2 * fp, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # b log b is 0 for values that never occur
+        total = np.where(tp + tn > 0, (tp + tn) * (1 / mu) * np.log(1 / mu), 0.) + \
+            np.where(fp > 0, fp * (2 / mu) * np.log(2 / mu), 0.)
+    return _divide(total, n)
+
+
+def classification_metrics(counts):
+    """
+    The fairness report of fairness_check from per-group confusion counts of
+    shape (3, 2, 2), as returned by confusion_counts with group_index codes,
+    or of a stack of such counts. Overall metrics cover every row, as aif360
+    does.
+    """
+    overall = rates(counts.sum(axis=-3))
+    unprivileged = rates(counts[..., UNPRIVILEGED, :, :])
+    privileged = rates(counts[..., PRIVILEGED, :, :])
+    return {
+        "Classification accuracy": overall["accuracy"],
+        "Balanced classification accuracy": 0.5 * (overall["TPR"] + overall["TNR"]),
+        "Statistical parity difference": unprivileged["selection_rate"] - privileged["selection_rate"],
+        "Disparate impact": _divide(unprivileged["selection_rate"], privileged["selection_rate"]),
+        "Equal opportunity difference": unprivileged["TPR"] - privileged["TPR"],
+        "Average odds difference": 0.5 * ((unprivileged["FPR"] - privileged["FPR"]) +
+                                          (unprivileged["TPR"] - privileged["TPR"])),
+        "Theil index": theil_index(counts.sum(axis=-3)),
+        "False negative rate difference": unprivileged["FNR"] - privileged["FNR"]
+    }
+
+
+def bootstrap_confidence_intervals(counts, n_resamples=1000, confidence_level=0.95, seed=None):
+    """
+    Percentile bootstrap intervals for every metric of classification_metrics.
+    Every metric only depends on how many rows fall in each (group, label,
+    prediction) cell, so resampling rows with replacement is the same as
+    drawing the cell counts from a multinomial with the observed cell
+    frequencies. All resamples are drawn at once and evaluated as one stack,
+    so 1000 resamples cost little more than a single evaluation.
+    """
+    rng = np.random.RandomState(seed)
+    cells = counts.ravel()
+    n = cells.sum()
+    resampled = rng.multinomial(n, cells / float(n), size=n_resamples).reshape((n_resamples,) + counts.shape)
+    tail = 100. * (1. - confidence_level) / 2.
+    intervals = {}
+    for name, values in classification_metrics(resampled).items():
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            intervals[name] = [float('nan'), float('nan')]
+        else:
+            intervals[name] = [float(np.percentile(values, tail)), float(np.percentile(values, 100. - tail))]
+    return intervals
+
+
+def fairness_counts(y_true, y_pred, protected, privileged_groups, unprivileged_groups, favorable_label=0.0):
+    """ Confusion counts of the unprivileged, privileged and other rows. """
+    group = group_index(protected, privileged_groups, unprivileged_groups)
+    return confusion_counts(y_true, y_pred, group, 3, favorable_label)
+
+
+def fairness_metrics(y_true, y_pred, protected, privileged_groups, unprivileged_groups, favorable_label=0.0):
+    """ The fairness_check report for one privileged/unprivileged pair. """
+    counts = fairness_counts(y_true, y_pred, protected, privileged_groups, unprivileged_groups, favorable_label)
+    return {key: float(value) for key, value in classification_metrics(counts).items()}
+
+
+def definition_counts(y_true, y_pred, protected, definitions, favorable_label=0.0):
+    """
+    Confusion counts of several, possibly overlapping, group definitions.
+    definitions maps a group name to an aif360 style list of {attribute:
+    value} dicts. The counts of all groups come out of one matrix product of
+    the (groups x rows) membership matrix with the one-hot confusion cells.
+    Returns the group names and counts of shape (groups, 2, 2).
+    """
+    names = list(definitions)
+    truth = (np.asarray(y_true).ravel() == favorable_label).astype(np.int64)
+    prediction = (np.asarray(y_pred).ravel() == favorable_label).astype(np.int64)
+    cells = np.eye(4)[truth * 2 + prediction]
+    membership = np.stack([group_membership(protected, definitions[name]) for name in names]).astype(np.float64)
+    counts = np.rint(membership.dot(cells)).astype(np.int64)
+    return names, counts.reshape(len(names), 2, 2)
+
+
+def intersection_counts(y_true, y_pred, protected, attributes, favorable_label=0.0):
+    """
+    Confusion counts of every observed combination of values of the given
+    protected attributes, e.g. ['race', 'gender'], from a single bincount.
+    Returns a list of {attribute: value} dicts and counts of shape
+    (groups, 2, 2).
+    """
+    values = []
+    codes = []
+    for attribute in attributes:
+        unique, inverse = np.unique(np.asarray(protected[attribute]).ravel(), return_inverse=True)
+        values.append(unique)
+        codes.append(inverse)
+    combined = np.ravel_multi_index(codes, [len(unique) for unique in values])
+    group_ids, group = np.unique(combined, return_inverse=True)
+    counts = confusion_counts(y_true, y_pred, group, len(group_ids), favorable_label)
+
+    value_index = np.unravel_index(group_ids, [len(unique) for unique in values])
+    keys = [{attribute: values[i][value_index[i][g]].item() for i, attribute in enumerate(attributes)}
+            for g in range(len(group_ids))]
+    return keys, counts
+
+
+def group_table(groups, counts, reference_counts):
+    """
+    Per-group metrics table. Every group's rates are compared with the
+    reference counts (usually the privileged group) using the same
+    differences and ratio as the fairness report.
+    """
+    group_rates = rates(counts)
+    reference = rates(reference_counts)
+    columns = {
+        "Count": counts.sum(axis=(1, 2)),
+        "Classification accuracy": group_rates["accuracy"],
+        "Selection rate": group_rates["selection_rate"],
+        "True positive rate": group_rates["TPR"],
+        "False positive rate": group_rates["FPR"],
+        "False negative rate": group_rates["FNR"],
+        "Statistical parity difference": group_rates["selection_rate"] - reference["selection_rate"],
+        "Disparate impact": _divide(group_rates["selection_rate"], reference["selection_rate"]),
+        "Equal opportunity difference": group_rates["TPR"] - reference["TPR"],
+        "Average odds difference": 0.5 * ((group_rates["FPR"] - reference["FPR"]) +
+                                          (group_rates["TPR"] - reference["TPR"])),
+        "False negative rate difference": group_rates["FNR"] - reference["FNR"]
+    }
+    table = []
+    for i, group in enumerate(groups):
+        row = {"Group": group}
+        row.update({name: column[i].item() for name, column in columns.items()})
+        table.append(row)
+    return table
+
+
+def group_fairness_table(y_true, y_pred, protected, privileged_groups, definitions=None, intersections=None,
+                         favorable_label=0.0):
+    """
+    Evaluate many groups against one set of predictions: the named group
+    definitions, plus every intersection of the attribute lists in
+    intersections. Each group is compared with privileged_groups.
+    """
+    _, reference = definition_counts(y_true, y_pred, protected, {'privileged': privileged_groups}, favorable_label)
+    table = []
+    if definitions:
+        names, counts = definition_counts(y_true, y_pred, protected, definitions, favorable_label)
+        table += group_table(names, counts, reference[0])
+    for attributes in intersections or []:
+        keys, counts = intersection_counts(y_true, y_pred, protected, attributes, favorable_label)
+        table += group_table(keys, counts, reference[0])
+    return table
@@ -0,0 +1,129 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Background jobs for long running checks. """
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job():
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'
+        self.phase = None
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def report(self, phase, progress=None):
+        """ Progress callback handed to the job function. """
+        self.phase = phase
+        if progress is not None:
+            self.progress = float(progress)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "phase": self.phase,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+# left out of the coalescing key, so that it never holds credentials
+REDACTED_PARAMETERS = ('object_storage_username', 'object_storage_password')
+
+
+class JobQueue():
+    """
+    Runs check functions on a bounded pool of worker threads. A submission
+    whose parameters, other than the credentials, match a job that is still
+    queued or running is coalesced into that job instead of starting another
+    run. Finished jobs are kept until history_size newer jobs have finished.
+    """
+    def __init__(self, max_workers=None, history_size=100):
+        if max_workers is None:
+            max_workers = int(os.environ.get('JOB_CONCURRENCY', 2))
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}
+        self._finished = collections.deque()
+        self.history_size = history_size
+
+    @staticmethod
+    def job_key(params):
+        params = dict((name, value) for name, value in params.items() if name not in REDACTED_PARAMETERS)
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def submit(self, fn, params):
+        """
+        Schedule fn(progress=job.report, **params) unless an identical job is
+        in flight, and return the job.
+        """
+        key = self.job_key(params)
+        with self._lock:
+            if key in self._active:
+                return self._active[key]
+            job = Job(key)
+            self._jobs[job.id] = job
+            self._active[key] = job
+        self._pool.submit(self._run, job, fn, params)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, params):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job.result = fn(progress=job.report, **params)
+            job.status = 'succeeded'
+            job.progress = 1.0
+        except Exception as e:
+            # the trace goes to the log only, it is not returned to clients
+            traceback.print_exc()
+            job.status = 'failed'
+            job.error = {
+                "error": e.__class__.__name__,
+                "message": str(e)
+            }
+        finally:
+            if job.status == 'running':
+                # stopped by something other than an Exception, e.g. SystemExit
+                job.status = 'failed'
+            job.finished_at = time.time()
+
+            with self._lock:
+                del self._active[job.key]
+                self._finished.append(job.id)
+                while len(self._finished) > self.history_size:
+                    self._jobs.pop(self._finished.popleft(), None)
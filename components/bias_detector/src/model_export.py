@@ -0,0 +1,192 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Optimized inference artifacts of a trained model. """
+import copy
+import inspect
+import json
+import os
+
+import numpy as np
+import torch
+
+'''
+Exported artifacts are stored next to the weights they were built from and
+named after them. For model.pt these are
+
+    model.torchscript.pt   frozen TorchScript of the fp32 model
+    model.int8.pt          frozen TorchScript of the int8 quantized model
+    model.onnx             ONNX graph with a dynamic batch dimension
+    model.export.json      accuracy drift of each artifact against model.pt
+
+The runtime 'eager' stands for the weights themselves, loaded into the
+user's model class.
+'''
+RUNTIMES = ('eager', 'torchscript', 'int8', 'onnx')
+SUFFIXES = {'torchscript': '.torchscript.pt', 'int8': '.int8.pt', 'onnx': '.onnx'}
+REPORT_SUFFIX = '.export.json'
+
+
+def artifact_name(weights_filename, runtime):
+    """ File name of the artifact of the given runtime, e.g. model.int8.pt for model.pt. """
+    if runtime == 'eager':
+        return weights_filename
+    return os.path.splitext(weights_filename)[0] + SUFFIXES[runtime]
+
+
+def report_name(weights_filename):
+    return os.path.splitext(weights_filename)[0] + REPORT_SUFFIX
+
+
+def to_torchscript(model, example, method='trace'):
+    """ Frozen TorchScript of an eval-mode model, traced on example or scripted. """
+    model.eval()
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example) if method == 'trace' else torch.jit.script(model)
+    return torch.jit.freeze(scripted)
+
+
+def quantize(model, mode='dynamic', calibration=None, backend='x86'):
+    """
+    int8 copy of a CPU model. dynamic quantizes the weights of the Linear
+    layers and the activations per batch at run time; static also quantizes
+    the convolutions, with activation ranges calibrated on the calibration
+    batches.
+    """
+    model = copy.deepcopy(model).eval()
+    if mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (calibration[0],))
+    with torch.no_grad():
+        for batch in calibration:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def export_onnx(model, example, path):
+    """ Needs the onnx package; the batch dimension stays dynamic. """
+    options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript based exporter handles dynamic_axes without onnxscript
+        options['dynamo'] = False
+    model.eval()
+    torch.onnx.export(model, example, path, input_names=['input'], output_names=['output'],
+                      dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, **options)
+
+
+class OnnxModel():
+    """ onnxruntime session called like the other runtimes, with and returning torch tensors. """
+    def __init__(self, path, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, X):
+        X = np.ascontiguousarray(X.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: X})[0])
+
+    def eval(self):
+        return self
+
+
+def load(path, runtime, device=None):
+    """ Load an exported artifact; quantized and ONNX models run on the CPU. """
+    if runtime == 'onnx':
+        return OnnxModel(path)
+    if runtime == 'int8' or device is None:
+        device = torch.device('cpu')
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    return model
+
+
+def _outputs(model, X, batch_size):
+    outputs = []
+    with torch.no_grad():
+        for start in range(0, len(X), batch_size):
+            images = torch.from_numpy(np.ascontiguousarray(X[start:start + batch_size], dtype=np.float32))
+            outputs.append(model(images).float())
+    return torch.cat(outputs)
+
+
+def drift_report(reference, models, X, y, batch_size=64):
+    """
+    Accuracy on (X, y) of the fp32 reference model and of each of the given
+    models by runtime, with how far each one drifts from the reference: the
+    change in accuracy, the share of predictions it agrees with the reference
+    on, and the largest and mean absolute difference of their outputs.
+    """
+    labels = torch.from_numpy(np.asarray(y).astype(np.int64))
+    expected = _outputs(reference, X, batch_size)
+    reference_accuracy = (expected.argmax(1) == labels).float().mean().item()
+    report = {"eager": {"accuracy": reference_accuracy}}
+    for runtime, model in models.items():
+        outputs = _outputs(model, X, batch_size)
+        accuracy = (outputs.argmax(1) == labels).float().mean().item()
+        difference = (outputs - expected).abs()
+        report[runtime] = {
+            "accuracy": accuracy,
+            "accuracy_drift": accuracy - reference_accuracy,
+            "agreement": (outputs.argmax(1) == expected.argmax(1)).float().mean().item(),
+            "max_abs_diff": difference.max().item(),
+            "mean_abs_diff": difference.mean().item()
+        }
+    return report
+
+
+def export_all(model, weights_path, X, y, runtimes=('torchscript', 'int8'), quantization='dynamic',
+               calibration=None, method='trace'):
+    """
+    Write the artifacts of the given runtimes next to weights_path, along
+    with their drift report on (X, y), which is returned. The model is
+    exported from a contiguous fp32 CPU copy, traced on the first row of X.
+    A runtime that cannot be exported here, e.g. ONNX without the onnx
+    package, is skipped with its error in the report.
+    """
+    model = copy.deepcopy(model).cpu().to(memory_format=torch.contiguous_format).eval()
+    example = torch.from_numpy(np.ascontiguousarray(X[0:1], dtype=np.float32))
+    directory, weights_filename = os.path.split(weights_path)
+    exported = {}
+    errors = {}
+    for runtime in runtimes:
+        path = os.path.join(directory, artifact_name(weights_filename, runtime))
+        try:
+            if runtime == 'torchscript':
+                torch.jit.save(to_torchscript(model, example, method), path)
+            elif runtime == 'int8':
+                torch.jit.save(to_torchscript(quantize(model, quantization, calibration), example), path)
+            elif runtime == 'onnx':
+                export_onnx(model, example, path)
+            else:
+                raise ValueError('Unknown runtime ' + runtime)
+            exported[runtime] = load(path, runtime)
+        except Exception as e:
+            print('Exporting ' + runtime + ' failed: ' + str(e))
+            errors[runtime] = '%s: %s' % (e.__class__.__name__, str(e))
+
+    report = drift_report(model, exported, X, y)
+    for runtime, error in errors.items():
+        report[runtime] = {"error": error}
+    if 'int8' in exported:
+        report['int8']['quantization'] = quantization
+    with open(os.path.join(directory, report_name(weights_filename)), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,256 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" In-process registry of loaded PyTorch models. """
+import collections
+import hashlib
+import importlib
+import os
+import shutil
+import sys
+import threading
+import time
+import tempfile
+import types
+import zipfile
+
+import torch
+
+import artifact_cache
+import model_export
+
+
+def model_nbytes(model):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+
+def model_objects(model_id, weights_filename='model.pt', runtime='eager'):
+    """
+    Names of the objects a model is loaded from: its weights and model.zip,
+    or the exported artifact of another runtime (see model_export).
+    """
+    if runtime != 'eager':
+        return [model_id + '/' + model_export.artifact_name(weights_filename, runtime)]
+    return [model_id + '/' + weights_filename, model_id + '/_submitted_code/model.zip']
+
+
+def load_model_class(model_zip_path, model_class_file, model_class_name, namespace, extract_dir):
+    """
+    Import the user's model class from model.zip into its own package, named
+    namespace, so that models whose files share a module name never pick up
+    each other's classes from sys.modules. The archive is extracted into
+    extract_dir, which belongs to the caller.
+    """
+    zip_ref = zipfile.ZipFile(model_zip_path, 'r')
+    zip_ref.extractall(extract_dir)
+    zip_ref.close()
+
+    package = types.ModuleType(namespace)
+    package.__path__ = [extract_dir]
+    sys.modules[namespace] = package
+    modulename = namespace + '.' + model_class_file.split('.')[0].replace('-', '_')
+
+    '''
+    We required users to define where the model class is located or follow
+    some naming convention we have provided.
+    '''
+    return getattr(importlib.import_module(modulename), model_class_name)
+
+
+def _remove_sources(namespace, extract_dir):
+    """ Forget the modules imported into namespace and delete their extracted sources. """
+    if namespace:
+        for name in [name for name in sys.modules if name == namespace or name.startswith(namespace + '.')]:
+            del sys.modules[name]
+    if extract_dir:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+class ModelRegistry():
+    """
+    Keeps ready-to-use models keyed by (model_id, weights ETag, model class),
+    so repeated checks on the same trained model skip the download, unzip,
+    import and torch.load steps. Retrained weights get a new ETag and are
+    loaded afresh. Least recently used models are dropped once the resident
+    parameters exceed max_bytes, except for pinned models.
+
+    The time spent in each phase of loading a model (fetch, import, load
+    and warm-up) is reported by stats.
+
+    The weights ETag is looked up on every get, unless revalidate_seconds is
+    set: then a model is served without a stat request for that long after
+    its ETag was last checked.
+
+    on_drop(model_id) is called once no version of model_id is resident any
+    more, after an unload or an eviction. It runs under the registry's lock,
+    so it must not call back into the registry.
+    """
+    def __init__(self, max_bytes=None, revalidate_seconds=0, on_drop=None):
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('MODEL_REGISTRY_MAX_BYTES', 2 * 1024 ** 3))
+        self.max_bytes = max_bytes
+        self.revalidate_seconds = revalidate_seconds
+        self.on_drop = on_drop
+        self._models = collections.OrderedDict()
+        self._etags = {}
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._counts = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _etag(self, client, bucket, weights_object):
+        now = time.time()
+        with self._lock:
+            etag, checked_at = self._etags.get((bucket, weights_object), (None, 0))
+        if etag is None or now - checked_at >= self.revalidate_seconds:
+            etag = client.stat_object(bucket, weights_object).etag.strip('"')
+            with self._lock:
+                self._etags[(bucket, weights_object)] = (etag, now)
+        return etag
+
+    def get(self, client, bucket, model_id, model_class_file='model.py', model_class_name='model',
+            weights_filename='model.pt', warm_up=None, runtime='eager'):
+        """
+        Return the model, loading it on first use. warm_up(model), if given,
+        runs once on a newly loaded model before it is handed out. With a
+        runtime other than 'eager', the model's exported TorchScript, int8 or
+        ONNX artifact is loaded instead of its weights and class.
+        """
+        objects = model_objects(model_id, weights_filename, runtime)
+        etag = self._etag(client, bucket, objects[0])
+        key = (model_id, etag, model_class_file, model_class_name, runtime)
+
+        with self._key_lock(key):
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self._counts["hits"] += 1
+                    return self._models[key][0]
+
+            timings = {}
+            started = time.time()
+            paths = artifact_cache.fetch_all(client, [(bucket, name) for name in objects])
+            timings["fetch_ms"], started = (time.time() - started) * 1000.0, time.time()
+            device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+            namespace = None
+            extract_dir = None
+            if runtime == 'eager':
+                weights_path, model_zip_path = paths
+                namespace = '_model_' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+                # the artifact cache only evicts files, so the sources live in a private
+                # directory that is removed along with the model
+                extract_dir = tempfile.mkdtemp(prefix=namespace + '-')
+                try:
+                    model_class = load_model_class(model_zip_path, model_class_file, model_class_name, namespace,
+                                                   extract_dir)
+                    timings["import_ms"], started = (time.time() - started) * 1000.0, time.time()
+
+                    # load & compile model
+                    model = model_class().to(device)
+                    model.load_state_dict(torch.load(weights_path, map_location=device))
+                    model.eval()
+                except Exception:
+                    _remove_sources(namespace, extract_dir)
+                    raise
+                nbytes = model_nbytes(model)
+            else:
+                model = model_export.load(paths[0], runtime, device)
+                # packed int8 weights and ONNX initializers are not parameters
+                nbytes = os.path.getsize(paths[0])
+            timings["load_ms"], started = (time.time() - started) * 1000.0, time.time()
+            if warm_up is not None:
+                warm_up(model)
+                timings["warm_up_ms"] = (time.time() - started) * 1000.0
+
+            with self._lock:
+                self._models[key] = (model, nbytes, namespace, timings, extract_dir)
+                self._counts["loads"] += 1
+                self._evict(keep=key)
+        return model
+
+    def share_memory(self):
+        """
+        Move the weights of the resident models to shared memory, so that
+        processes forked afterwards use them without copying. Frozen
+        TorchScript constants and ONNX sessions stay where they are.
+        """
+        with self._lock:
+            for model, nbytes, namespace, timings, extract_dir in self._models.values():
+                if hasattr(model, 'share_memory'):
+                    model.share_memory()
+
+    def pin(self, model_id):
+        """ Never evict the versions of model_id. """
+        with self._lock:
+            self._pinned.add(model_id)
+
+    def unpin(self, model_id):
+        with self._lock:
+            self._pinned.discard(model_id)
+            self._evict()
+
+    def unload(self, model_id):
+        """ Drop every resident version of model_id. Returns whether one was resident. """
+        with self._lock:
+            keys = [key for key in self._models if key[0] == model_id]
+            for key in keys:
+                self._drop(key)
+            self._etags = {key: value for key, value in self._etags.items()
+                           if not key[1].startswith(model_id + '/')}
+            return bool(keys)
+
+    def _drop(self, key):
+        model, nbytes, namespace, timings, extract_dir = self._models.pop(key)
+        self._key_locks.pop(key, None)
+        _remove_sources(namespace, extract_dir)
+        if self.on_drop is not None and not any(other[0] == key[0] for other in self._models):
+            self.on_drop(key[0])
+        return nbytes
+
+    def _evict(self, keep=None):
+        total = sum(entry[1] for entry in self._models.values())
+        for key in list(self._models):
+            if total <= self.max_bytes:
+                break
+            if key == keep or key[0] in self._pinned:
+                continue
+            total -= self._drop(key)
+            self._counts["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "models": [{"model_id": key[0], "etag": key[1], "runtime": key[4], "bytes": entry[1],
+                            "pinned": key[0] in self._pinned, "timings": entry[3]}
+                           for key, entry in self._models.items()],
+                "pinned": sorted(self._pinned),
+                "bytes": sum(entry[1] for entry in self._models.values()),
+                "max_bytes": self.max_bytes
+            }
+            stats.update(self._counts)
+            return stats
+
+
+_default_registry = None
+
+
+def default_registry():
+    """ Process wide registry bounded by MODEL_REGISTRY_MAX_BYTES. """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = ModelRegistry()
+    return _default_registry
@@ -0,0 +1,105 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Model predictions on the test set, shared between checks through the results bucket. """
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+from minio.error import S3Error
+
+import artifact_cache
+
+'''
+Predictions are stored next to the trained model, under
+<model_id>/_predictions/<key>/{logits,softmax}.npy, where the key hashes the
+ETags of the weights and of the feature test set together with the model
+class. Retraining the model or regenerating the test set changes the key.
+'''
+PREDICTIONS_PREFIX = '_predictions'
+
+
+def prediction_key(client, data_bucket_name, result_bucket_name, model_id, feature_testset_path,
+                   model_class_file='model.py', model_class_name='model', weights_filename='model.pt'):
+    """ Object name prefix of the predictions of this model on this test set. """
+    weights_etag = client.stat_object(result_bucket_name, model_id + '/' + weights_filename).etag.strip('"')
+    testset_etag = client.stat_object(data_bucket_name, feature_testset_path).etag.strip('"')
+    key = hashlib.sha256('|'.join([weights_etag, model_class_file, model_class_name,
+                                   data_bucket_name, feature_testset_path, testset_etag]).encode('utf-8')).hexdigest()
+    return '%s/%s/%s/' % (model_id, PREDICTIONS_PREFIX, key)
+
+
+def predict(model, x, batch_size=64):
+    """ Logits and softmax outputs of the model over x, which may be memory-mapped. """
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model.eval()
+    n = x.shape[0]
+    logits = None
+    with torch.no_grad():
+        for start in range(0, n, batch_size):
+            images = torch.from_numpy(np.ascontiguousarray(x[start:start + batch_size], dtype=np.float32))
+            outputs = model(images.to(device)).cpu()
+            if logits is None:
+                logits = np.empty((n, outputs.shape[1]), dtype=np.float32)
+            logits[start:start + outputs.shape[0]] = outputs.numpy()
+    softmax = torch.softmax(torch.from_numpy(logits), dim=1).numpy()
+    return logits, softmax
+
+
+def load(client, bucket, prefix):
+    """ Return the stored (logits, softmax), or None if they were never stored. """
+    try:
+        logits_path, softmax_path = artifact_cache.fetch_all(client, [
+            (bucket, prefix + 'logits.npy'),
+            (bucket, prefix + 'softmax.npy')
+        ])
+    except S3Error as e:
+        if e.code in ('NoSuchKey', 'NoSuchObject'):
+            return None
+        raise
+    return np.load(logits_path), np.load(softmax_path)
+
+
+def store(client, bucket, prefix, logits, softmax):
+    """ Upload the predictions; softmax goes last, so load never finds it without the logits. """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, array in (('logits.npy', logits), ('softmax.npy', softmax)):
+            path = os.path.join(tmp_dir, name)
+            np.save(path, array)
+            client.fput_object(bucket, prefix + name, path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def get_predictions(client, data_bucket_name, result_bucket_name, model_id, feature_testset_path, x, get_model,
+                    model_class_file='model.py', model_class_name='model'):
+    """
+    Logits and softmax outputs of the trained model on the feature test set.
+    They are read from the results bucket when another check already stored
+    them; otherwise get_model() is called, x is predicted, and the result is
+    stored for the next check. x may also be a callable returning the
+    features, so a check with stored predictions never loads them.
+    """
+    prefix = prediction_key(client, data_bucket_name, result_bucket_name, model_id, feature_testset_path,
+                            model_class_file=model_class_file, model_class_name=model_class_name)
+    predictions = load(client, result_bucket_name, prefix)
+    if predictions is None:
+        if callable(x):
+            x = x()
+        predictions = predict(get_model(), x)
+        store(client, result_bucket_name, prefix, *predictions)
+    return predictions
@@ -0,0 +1,291 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Sharded, memory-mappable storage for processed datasets. """
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+INDEX_FILENAME = 'index.json'
+FORMAT = 'sharded-npy'
+
+'''
+A sharded dataset is a directory holding fixed-size shards shard-00000.npy,
+shard-00001.npy, ... and an index.json such as
+
+    {"format": "sharded-npy", "version": 1,
+     "shape": [23705, 3, 64, 64], "dtype": "float32",
+     "storage_dtype": "uint8", "scale": 0.0078125, "offset": -1.0,
+     "shards": [{"file": "shard-00000.npy", "start": 0, "stop": 4096,
+                 "sha256": "..."}, ...]}
+
+Shards keep the rows in a compact storage dtype (uint8 or float16). Readers
+decode them to dtype as stored * scale + offset, one batch at a time.
+'''
+ENCODINGS = {
+    # 8 bit pixels normalized to [-1, 1) as 2 * pixel / 256 - 1
+    'uint8': {'storage_dtype': 'uint8', 'scale': 2.0 / 256.0, 'offset': -1.0},
+    'float16': {'storage_dtype': 'float16', 'scale': 1.0, 'offset': 0.0}
+}
+
+
+def file_sha256(path, block_size=1024 ** 2):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _save_shard(path, shard, rows):
+    """ Atomically (re)write a shard file and update its index entry. """
+    shard_path = os.path.join(path, shard['file'])
+    tmp_path = shard_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, rows)
+    os.replace(tmp_path, shard_path)
+    shard['stop'] = shard['start'] + rows.shape[0]
+    shard['sha256'] = file_sha256(shard_path)
+
+
+def read_index(path):
+    with open(os.path.join(path, INDEX_FILENAME)) as f:
+        return json.load(f)
+
+
+def _write_index(path, index):
+    index_path = os.path.join(path, INDEX_FILENAME)
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def write_sharded(path, n_rows, read_rows, row_shape, encoding='uint8', rows_per_shard=4096, dtype='float32',
+                  append=False):
+    """
+    Write n_rows rows as a sharded dataset in directory path. read_rows(start,
+    stop) returns the rows in [start, stop) already in the storage dtype of
+    the encoding, so that no more than one shard is held in memory.
+
+    With append, the rows are added after those of the dataset already in
+    path: its last shard is topped up to rows_per_shard rows and new shards
+    hold the rest, so existing full shards are never rewritten.
+    """
+    encoding = ENCODINGS[encoding]
+    storage_dtype = encoding['storage_dtype']
+    if append and os.path.exists(os.path.join(path, INDEX_FILENAME)):
+        index = read_index(path)
+        if index['storage_dtype'] != storage_dtype or index['shape'][1:] != list(row_shape):
+            raise ValueError('Cannot append %s rows of shape %s to %s' % (storage_dtype, list(row_shape), path))
+    else:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        index = {
+            "format": FORMAT,
+            "version": 1,
+            "shape": [0] + list(row_shape),
+            "dtype": dtype,
+            "storage_dtype": storage_dtype,
+            "scale": encoding['scale'],
+            "offset": encoding['offset'],
+            "shards": []
+        }
+    shards = index['shards']
+    total = index['shape'][0]
+
+    start = 0
+    if n_rows and shards and shards[-1]['stop'] - shards[-1]['start'] < rows_per_shard:
+        last = shards[-1]
+        start = min(rows_per_shard - (last['stop'] - last['start']), n_rows)
+        rows = np.concatenate([np.load(os.path.join(path, last['file'])),
+                               np.asarray(read_rows(0, start), dtype=storage_dtype)])
+        _save_shard(path, last, rows)
+    while start < n_rows:
+        stop = min(start + rows_per_shard, n_rows)
+        shard = {"file": 'shard-%05d.npy' % len(shards), "start": total + start}
+        _save_shard(path, shard, np.ascontiguousarray(read_rows(start, stop), dtype=storage_dtype))
+        shards.append(shard)
+        start = stop
+
+    index['shape'][0] = total + n_rows
+    _write_index(path, index)
+    return index
+
+
+def update_rows(path, rows, values):
+    """
+    Overwrite the given rows of the sharded dataset in path with values in
+    its storage dtype, rewriting only the shards that hold them.
+    """
+    index = read_index(path)
+    rows = np.asarray(rows)
+    starts = np.array([shard['start'] for shard in index['shards']], dtype=np.int64)
+    shard_ids = np.searchsorted(starts, rows, side='right') - 1
+    for i in np.unique(shard_ids):
+        shard = index['shards'][i]
+        selected = shard_ids == i
+        data = np.load(os.path.join(path, shard['file']))
+        data[rows[selected] - shard['start']] = values[selected]
+        _save_shard(path, shard, data)
+    _write_index(path, index)
+
+
+def truncate(path, n_rows):
+    """
+    Cut the sharded dataset in path down to its first n_rows rows, e.g. to
+    drop the rows appended by a run that stopped before recording them.
+    Shards past n_rows are deleted, including any written without reaching
+    the index, as are the temporary files of interrupted writes, and the
+    shard holding the last row is rewritten if needed.
+    """
+    index = read_index(path)
+    if n_rows > index['shape'][0]:
+        raise ValueError('Cannot truncate %s to %d rows, it only holds %d' % (path, n_rows, index['shape'][0]))
+    shards = [shard for shard in index['shards'] if shard['start'] < n_rows]
+    if shards:
+        last = shards[-1]
+        rows = np.load(os.path.join(path, last['file']), mmap_mode='r')
+        # the file may hold more rows than its index entry if a run stopped mid-append
+        if rows.shape[0] != n_rows - last['start']:
+            _save_shard(path, last, np.array(rows[:n_rows - last['start']]))
+        del rows
+    kept = set(shard['file'] for shard in shards)
+    for name in os.listdir(path):
+        if name.endswith('.tmp') or (name.startswith('shard-') and name not in kept):
+            os.remove(os.path.join(path, name))
+    index['shards'] = shards
+    index['shape'][0] = n_rows
+    _write_index(path, index)
+    return index
+
+
+class ShardedArray():
+    """
+    Read-only, array-like view of a sharded dataset. Indexing with an int, a
+    slice or an array of row indices only loads (memory-maps) the shards
+    holding those rows and decodes just the selected rows. shard_path(file)
+    returns the local path of a shard, which lets shards be downloaded from
+    object storage on first use. With verify, a shard's checksum is checked
+    the first time it is opened.
+    """
+    def __init__(self, index, shard_path, verify=True):
+        if index.get('format') != FORMAT:
+            raise ValueError('Not a sharded dataset index: format is %r' % index.get('format'))
+        self.index = index
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.ndim = len(self.shape)
+        self.scale = index['scale']
+        self.offset = index['offset']
+        self._shard_path = shard_path
+        self._verify = verify
+        self._starts = np.array([shard['start'] for shard in index['shards']], dtype=np.int64)
+        self._shards = [None] * len(index['shards'])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _shard(self, i):
+        if self._shards[i] is None:
+            shard = self.index['shards'][i]
+            path = self._shard_path(shard['file'])
+            if self._verify and file_sha256(path) != shard['sha256']:
+                raise IOError('Checksum mismatch in shard ' + shard['file'])
+            self._shards[i] = np.load(path, mmap_mode='r')
+        return self._shards[i]
+
+    def prefetch(self, max_workers=8):
+        """ Open (and fetch) every shard now, several at a time. """
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(self._shard, range(len(self._shards))))
+
+    def _decode(self, rows):
+        rows = rows.astype(self.dtype)
+        if self.scale != 1.0:
+            rows *= self.dtype.type(self.scale)
+        if self.offset != 0.0:
+            rows += self.dtype.type(self.offset)
+        return rows
+
+    def _take(self, indices):
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self._starts, indices, side='right') - 1
+        for i in np.unique(shard_ids):
+            selected = shard_ids == i
+            local = indices[selected] - self._starts[i]
+            if local.size and np.all(local[1:] == local[:-1] + 1):
+                # contiguous rows are read as one slice of the memory map
+                out[selected] = self._decode(self._shard(i)[local[0]:local[-1] + 1])
+            else:
+                out[selected] = self._decode(self._shard(i)[local])
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            return self._take(np.arange(*key.indices(self.shape[0])))
+        indices = np.asarray(key)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        if indices.ndim == 0:
+            return self._take(indices.reshape(1) % self.shape[0])[0]
+        return self._take(np.where(indices < 0, indices + self.shape[0], indices))
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+
+def is_sharded(path):
+    """ Sharded datasets are referred to by their index.json. """
+    return path.endswith('.json')
+
+
+def open_sharded(index_path, fetch=None, verify=True):
+    """
+    Open the sharded dataset described by a local index.json. Shards are read
+    from the index's directory, or from fetch(file) when given, e.g. a
+    function downloading them from object storage.
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+    if fetch is None:
+        directory = os.path.dirname(index_path)
+        fetch = lambda name: os.path.join(directory, name)
+    return ShardedArray(index, fetch, verify=verify)
+
+
+def open_sharded_object(client, bucket, index_object, fetch, verify=True):
+    """
+    Open a sharded dataset in object storage by the name of its index.json.
+    fetch(client, bucket, object_name) returns a local copy of an object,
+    e.g. artifact_cache.fetch; every shard is fetched on first use.
+    """
+    prefix = index_object[:index_object.rfind('/') + 1]
+    return open_sharded(fetch(client, bucket, index_object),
+                        fetch=lambda name: fetch(client, bucket, prefix + name), verify=verify)
+
+
+def load_array(directory, name, mmap_mode=None):
+    """
+    Load the processed array name (e.g. 'X_train') from directory, either a
+    sharded dataset in directory/name/ or directory/name.npy.
+    """
+    index_path = os.path.join(directory, name, INDEX_FILENAME)
+    if os.path.exists(index_path):
+        return open_sharded(index_path)
+    return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
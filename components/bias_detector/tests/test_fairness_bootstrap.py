@@ -0,0 +1,70 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Bootstrap confidence intervals of the fairness metrics. """
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fairness_metrics import bootstrap_confidence_intervals, fairness_counts, fairness_metrics  # noqa: E402
+
+PRIVILEGED_GROUPS = [{'race': 0.0}]
+UNPRIVILEGED_GROUPS = [{'race': 4.0}]
+
+
+def random_test_set(seed, n=4000):
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(0, 2, n).astype(np.float64)
+    y_pred = np.where(rng.rand(n) < 0.7, y_true, 1 - y_true)
+    return y_true, y_pred, {'race': rng.choice([0.0, 1.0, 4.0], n)}
+
+
+def test_intervals_contain_the_point_estimates():
+    y_true, y_pred, protected = random_test_set(0)
+    metrics = fairness_metrics(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    counts = fairness_counts(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    intervals = bootstrap_confidence_intervals(counts, n_resamples=500, confidence_level=0.9, seed=0)
+    assert sorted(intervals) == sorted(metrics)
+    for name, (lower, upper) in intervals.items():
+        assert lower <= metrics[name] <= upper, name
+        assert upper - lower < 0.2, name
+
+
+def test_intervals_narrow_with_the_confidence_level():
+    y_true, y_pred, protected = random_test_set(1)
+    counts = fairness_counts(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    wide = bootstrap_confidence_intervals(counts, n_resamples=500, confidence_level=0.99, seed=0)
+    narrow = bootstrap_confidence_intervals(counts, n_resamples=500, confidence_level=0.5, seed=0)
+    for name in wide:
+        assert wide[name][0] <= narrow[name][0] <= narrow[name][1] <= wide[name][1], name
+
+
+def test_metrics_undefined_in_every_resample_get_nan_intervals():
+    y_true, y_pred, protected = random_test_set(2)
+    # no unprivileged row has the favorable label, so its true positive rate is undefined
+    y_true[protected['race'] == 4.0] = 1.0
+    counts = fairness_counts(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    intervals = bootstrap_confidence_intervals(counts, n_resamples=200, seed=0)
+    assert all(math.isnan(bound) for bound in intervals["Equal opportunity difference"])
+    assert all(math.isfinite(bound) for bound in intervals["Statistical parity difference"])
+
+
+def test_resamples_are_reproducible_with_a_seed():
+    y_true, y_pred, protected = random_test_set(3)
+    counts = fairness_counts(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    assert bootstrap_confidence_intervals(counts, n_resamples=100, seed=7) == \
+        bootstrap_confidence_intervals(counts, n_resamples=100, seed=7)
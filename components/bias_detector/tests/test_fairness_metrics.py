@@ -0,0 +1,69 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Parity of the native fairness_metrics engine with aif360. """
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from aif360.datasets import BinaryLabelDataset
+from aif360.metrics import ClassificationMetric
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fairness_metrics import fairness_metrics  # noqa: E402
+
+FAVORABLE_LABEL = 0.0
+UNFAVORABLE_LABEL = 1.0
+PRIVILEGED_GROUPS = [{'race': 0.0}]
+UNPRIVILEGED_GROUPS = [{'race': 4.0}]
+
+
+def random_test_set(seed, n=500):
+    rng = np.random.RandomState(seed)
+    y_true = rng.randint(0, 2, n).astype(np.float64)
+    # predictions that agree with the labels more often than not
+    y_pred = np.where(rng.rand(n) < 0.7, y_true, 1 - y_true)
+    return y_true, y_pred, {'race': rng.choice([0.0, 1.0, 2.0, 4.0], n)}
+
+
+def aif360_metric(y_true, y_pred, protected, privileged_groups, unprivileged_groups):
+    """ aif360's ClassificationMetric of the predictions. """
+    def dataset(outcome):
+        df = pd.DataFrame(dict(protected, outcome=outcome))
+        return BinaryLabelDataset(favorable_label=FAVORABLE_LABEL, unfavorable_label=UNFAVORABLE_LABEL, df=df,
+                                  label_names=['outcome'], protected_attribute_names=list(protected))
+    return ClassificationMetric(dataset(y_true), dataset(y_pred), unprivileged_groups=unprivileged_groups,
+                                privileged_groups=privileged_groups)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_classification_metrics_match_aif360(seed):
+    y_true, y_pred, protected = random_test_set(seed)
+    metric = aif360_metric(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS)
+    expected = {
+        "Classification accuracy": metric.accuracy(),
+        "Balanced classification accuracy": 0.5 * (metric.true_positive_rate() + metric.true_negative_rate()),
+        "Statistical parity difference": metric.statistical_parity_difference(),
+        "Disparate impact": metric.disparate_impact(),
+        "Equal opportunity difference": metric.equal_opportunity_difference(),
+        "Average odds difference": metric.average_odds_difference(),
+        "Theil index": metric.theil_index(),
+        "False negative rate difference": metric.false_negative_rate_difference()
+    }
+    actual = fairness_metrics(y_true, y_pred, protected, PRIVILEGED_GROUPS, UNPRIVILEGED_GROUPS, FAVORABLE_LABEL)
+    assert sorted(actual) == sorted(expected)
+    for name in expected:
+        assert actual[name] == pytest.approx(expected[name], rel=1e-9, abs=1e-12), name
@@ -0,0 +1,108 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Coalescing and lifecycle of background jobs. """
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from jobs import JobQueue  # noqa: E402
+
+PARAMS = {
+    "object_storage_url": 'http://minio:9000',
+    "object_storage_username": 'user',
+    "object_storage_password": 'secret',
+    "model_id": 'training-1',
+    "data_bucket_name": 'data',
+    "result_bucket_name": 'results'
+}
+
+
+def wait(queue, job, timeout=10):
+    deadline = time.time() + timeout
+    while job.finished_at is None:
+        assert time.time() < deadline, 'job %s never finished' % job.id
+        time.sleep(0.001)
+    return job
+
+
+def test_identical_submissions_share_a_job_in_flight():
+    release = threading.Event()
+    calls = []
+
+    def check(progress, **params):
+        calls.append(params)
+        progress('waiting', 0.5)
+        release.wait()
+        return {"ok": True}
+
+    queue = JobQueue(max_workers=2)
+    first = queue.submit(check, dict(PARAMS))
+    other_credentials = dict(PARAMS, object_storage_username='other', object_storage_password='other')
+    assert queue.submit(check, other_credentials) is first
+    other_model = queue.submit(check, dict(PARAMS, model_id='training-2'))
+    assert other_model is not first
+    release.set()
+    assert wait(queue, first).to_dict()["result"] == {"ok": True}
+    wait(queue, other_model)
+    assert len(calls) == 2
+    # a finished job is not coalesced into
+    assert queue.submit(check, dict(PARAMS)) is not first
+
+
+def test_job_key_holds_no_credentials():
+    assert JobQueue.job_key(PARAMS) == JobQueue.job_key(dict(PARAMS, object_storage_password='changed'))
+    assert JobQueue.job_key(PARAMS) != JobQueue.job_key(dict(PARAMS, data_bucket_name='changed'))
+
+
+def test_job_reports_progress_and_result():
+    def check(progress, **params):
+        progress('scoring', 0.25)
+        return {"model_id": params["model_id"]}
+
+    queue = JobQueue(max_workers=1)
+    job = wait(queue, queue.submit(check, dict(PARAMS)))
+    state = job.to_dict()
+    assert state["status"] == 'succeeded' and state["phase"] == 'scoring'
+    assert state["progress"] == 1.0 and state["result"] == {"model_id": 'training-1'}
+    assert state["started_at"] <= state["finished_at"]
+
+
+def test_failed_job_reports_only_the_message():
+    def check(progress, **params):
+        raise ValueError('no test set')
+
+    queue = JobQueue(max_workers=1)
+    job = wait(queue, queue.submit(check, dict(PARAMS)))
+    assert job.status == 'failed'
+    assert job.error == {"error": 'ValueError', "message": 'no test set'}
+
+
+def test_job_stopped_by_a_base_exception_is_released():
+    def check(progress, **params):
+        raise SystemExit(1)
+
+    queue = JobQueue(max_workers=1)
+    job = wait(queue, queue.submit(check, dict(PARAMS)))
+    assert job.status == 'failed'
+    assert queue.submit(check, dict(PARAMS)) is not job
+
+
+def test_history_is_bounded():
+    queue = JobQueue(max_workers=1, history_size=2)
+    jobs = [wait(queue, queue.submit(lambda progress, **params: i, dict(PARAMS, model_id=str(i))))
+            for i in range(4)]
+    assert [queue.get(job.id) is not None for job in jobs] == [False, False, True, True]
@@ -17,28 +17,77 @@ import json
 from flask import Flask, request, abort
 from flask_cors import CORS
 
-from robustness import robustness_check
+from robustness import robustness_check, robustness_sweep
+from jobs import JobQueue
 
 app = Flask(__name__)
 CORS(app)
 
+# Bounded pool running POST /jobs submissions, sized by JOB_CONCURRENCY.
+job_queue = JobQueue()
+
+# Optional robustness_check arguments accepted by POST /jobs. With epsilons
+# (and attacks) a job runs a robustness sweep instead. Jobs run in a thread of
+# this process, which cannot fork attack workers, so workers is not accepted.
+JOB_PARAMETERS = ('feature_testset_path', 'label_testset_path', 'model_class_file', 'model_class_name',
+                  'epsilon', 'chunk_size', 'bootstrap_resamples', 'epsilons', 'attacks')
+
+
+def robustness_job(epsilons=None, attacks=None, epsilon=None, **params):
+    if epsilons:
+        return robustness_sweep(epsilons=epsilons, attacks=attacks or ('fgsm',), **params)
+    if epsilon is not None:
+        params['epsilon'] = epsilon
+    return robustness_check(**params)
+
 
 @app.route('/', methods=['POST'])
 def robustness_api():
     try:
         s3_url = request.json['aws_endpoint_url']
-        bucket_name = request.json['training_results_bucket']
+        result_bucket_name = request.json['training_results_bucket']
         s3_username = request.json['aws_access_key_id']
         s3_password = request.json['aws_secret_access_key']
         model_id = request.json['model_id']
+        data_bucket_name = request.json['training_data_bucket']
     except:
         abort(400)
-    return json.dumps(robustness_check(s3_url, bucket_name, s3_username, s3_password, model_id))
+    return json.dumps(robustness_check(s3_url, s3_username, s3_password, data_bucket_name, result_bucket_name, model_id))
 
 @app.route('/', methods=['OPTIONS'])
 def robustness_api_options():
     return "200"
 
 
+@app.route('/jobs', methods=['POST'])
+def robustness_job_api():
+    try:
+        params = {
+            "object_storage_url": request.json['aws_endpoint_url'],
+            "result_bucket_name": request.json['training_results_bucket'],
+            "object_storage_username": request.json['aws_access_key_id'],
+            "object_storage_password": request.json['aws_secret_access_key'],
+            "model_id": request.json['model_id'],
+            "data_bucket_name": request.json['training_data_bucket']
+        }
+        for name in JOB_PARAMETERS:
+            if name in request.json:
+                params[name] = request.json[name]
+        if int(request.json.get('workers', 1)) > 1:
+            abort(400)
+    except:
+        abort(400)
+    job = job_queue.submit(robustness_job, params)
+    return json.dumps({"job_id": job.id, "status": job.status}), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def robustness_job_status_api(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return json.dumps(job.to_dict())
+
+
 if __name__ == "__main__":
     app.run(debug=True,host='0.0.0.0',port=int(os.environ.get('PORT', 8080)))
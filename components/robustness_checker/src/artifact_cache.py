@@ -0,0 +1,176 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Local cache for objects downloaded from the object storage. """
+import hashlib
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ArtifactCache():
+    """
+    Content-addressed cache of object storage downloads. Entries are keyed by
+    bucket, object name and ETag, so a changed object is downloaded again
+    while an unchanged one is only checked with a stat (HEAD) request.
+    Downloads are written to a temporary file and renamed into place, so
+    concurrent fetches never see a partially written file. Least recently
+    used entries are evicted to make room for a download once the cache
+    would grow beyond max_bytes. Objects of at least ranged_threshold bytes
+    are downloaded as parallel ranged GETs of part_size bytes each.
+
+    A path handed out by fetch is in use for pin_seconds: until then it is
+    never evicted, by this or any other process sharing cache_dir, so callers
+    can open it. Should the entries in use exceed max_bytes, the cache
+    outgrows max_bytes for that long rather than delete them.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None, max_workers=8,
+                 ranged_threshold=64 * 1024 ** 2, part_size=16 * 1024 ** 2, pin_seconds=None):
+        self.cache_dir = cache_dir or os.environ.get('ARTIFACT_CACHE_DIR', '/tmp/artifact-cache')
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', 4 * 1024 ** 3))
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.ranged_threshold = ranged_threshold
+        self.part_size = part_size
+        if pin_seconds is None:
+            pin_seconds = float(os.environ.get('ARTIFACT_CACHE_PIN_SECONDS', 300))
+        self.pin_seconds = pin_seconds
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _lock_key(self, key):
+        # [lock, number of fetches holding or waiting for it]
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        return entry
+
+    def _unlock_key(self, key, entry):
+        entry[0].release()
+        with self._lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[key]
+
+    def path_for(self, bucket, object_name, etag):
+        key = hashlib.sha256((bucket + '/' + object_name + '@' + etag).encode('utf-8')).hexdigest()
+        suffix = os.path.splitext(object_name)[1]
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def fetch(self, client, bucket, object_name):
+        """ Return the local path of an object, downloading it only if it is not cached. """
+        stat = client.stat_object(bucket, object_name)
+        etag = stat.etag.strip('"')
+        path = self.path_for(bucket, object_name, etag)
+        entry = self._lock_key(path)
+        try:
+            if os.path.exists(path):
+                # refresh the access time used for LRU eviction and pinning
+                os.utime(path, None)
+                return path
+            # make room first, so that no path handed out before is removed for this one
+            self.evict(reserve=stat.size)
+            tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            try:
+                if stat.size >= self.ranged_threshold:
+                    self._ranged_download(client, bucket, object_name, stat.size, etag, tmp_path)
+                else:
+                    client.fget_object(bucket, object_name, tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            return path
+        finally:
+            self._unlock_key(path, entry)
+
+    def fetch_all(self, client, objects):
+        """
+        Fetch several (bucket, object_name) pairs concurrently over the same
+        client and return their local paths in the same order.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda obj: self.fetch(client, obj[0], obj[1]), objects))
+
+    def _ranged_download(self, client, bucket, object_name, size, etag, tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.truncate(size)
+        fd = os.open(tmp_path, os.O_WRONLY)
+
+        def download_part(offset):
+            length = min(self.part_size, size - offset)
+            # If-Match makes every part fail rather than mix two versions of the object
+            response = client.get_object(bucket, object_name, offset=offset, length=length,
+                                         request_headers={'If-Match': '"%s"' % etag})
+            try:
+                for data in response.stream(1024 ** 2):
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+            finally:
+                response.close()
+                response.release_conn()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                list(pool.map(download_part, range(0, size, self.part_size)))
+        finally:
+            os.close(fd)
+
+    def evict(self, reserve=0):
+        """
+        Remove least recently used entries until reserve more bytes fit in
+        max_bytes. Entries fetched in the last pin_seconds are kept.
+        """
+        with self._lock:
+            pinned_since = time.time() - self.pin_seconds
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.endswith('.tmp') or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries) + reserve
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes or mtime >= pinned_since:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+
+_default_cache = None
+
+
+def default_cache():
+    """ Process wide cache configured by ARTIFACT_CACHE_DIR and ARTIFACT_CACHE_MAX_BYTES. """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ArtifactCache()
+    return _default_cache
+
+
+def fetch(client, bucket, object_name):
+    return default_cache().fetch(client, bucket, object_name)
+
+
+def fetch_all(client, objects):
+    return default_cache().fetch_all(client, objects)
@@ -19,84 +19,289 @@ from minio import Minio
 
 import torch
 import torch.utils.data
-from torch.autograd import Variable
 
 from art.classifiers.pytorch import PyTorchClassifier
 from art.attacks.fast_gradient import FastGradientMethod
+from art.attacks.projected_gradient_descent import ProjectedGradientDescent
+from art.attacks.deepfool import DeepFool
 
-import zipfile
-import importlib
+import multiprocessing
 import re
-
-
-def get_metrics(model, x_original, x_adv_samples, y):
-    model_accuracy_on_non_adversarial_samples, y_pred = evaluate(model, x_original, y)
-    model_accuracy_on_adversarial_samples, y_pred_adv = evaluate(model, x_adv_samples, y)
-
-    pert_metric = get_perturbation_metric(x_original, x_adv_samples, y_pred, y_pred_adv, ord=2)
-    conf_metric = get_confidence_metric(y_pred, y_pred_adv)
-
-    data = {
-        "model accuracy on test data": float(model_accuracy_on_non_adversarial_samples),
-        "model accuracy on adversarial samples": float(model_accuracy_on_adversarial_samples),
-        "confidence reduced on correctly classified adv_samples": float(conf_metric),
-        "average perturbation on misclassified adv_samples": float(pert_metric)
-    }
-    return data, y_pred, y_pred_adv
-
-
-# Compute the accuaracy and predicted label using the given test dataset
-def evaluate(model, X_test, y_test):
+import threading
+
+import artifact_cache
+import model_registry
+import prediction_cache
+import sharded_dataset
+
+
+def get_metrics(model, x_original, x_adv_samples, y, bootstrap_resamples=0, softmax=None):
+    clean = None if softmax is None else clean_results(softmax, x_original)
+    results = evaluate_fused(model, x_original, x_adv_samples, clean=clean)
+    accumulator = RobustnessAccumulator(bootstrap_resamples)
+    accumulator.update(results, y)
+    return accumulator.metrics(), results['y_pred'], results['y_pred_adv']
+
+
+def evaluate_fused(model, x_original, x_adv, batch_size=64, ord=2, clean=None):
+    """
+    Run clean and adversarial inputs through the model together, one forward
+    pass per batch, and fill preallocated result buffers with the softmax
+    outputs, predicted class, its confidence and the perturbation norms.
+    Float32 inputs are passed to torch without copying.
+    If clean holds the results of an earlier call on the same x_original, its
+    clean buffers are reused and only the adversarial inputs are evaluated.
+    """
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    test = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_test.astype('float32'))), Variable(torch.LongTensor(y_test.astype('float32'))))
-    test_loader = torch.utils.data.DataLoader(test, batch_size=64, shuffle=False)
     model.eval()
-    correct = 0
-    accuracy = 0
-    y_pred = []
+    n = x_original.shape[0]
+    results = {
+        'y_pred': None,
+        'y_pred_adv': None,
+        'label': np.empty(n, dtype=np.int64),
+        'label_adv': np.empty(n, dtype=np.int64),
+        'conf': np.empty(n, dtype=np.float32),
+        'conf_adv': np.empty(n, dtype=np.float32),
+        'pert_norm': np.empty(n, dtype=np.float32),
+        'x_norm': np.empty(n, dtype=np.float32)
+    }
+    if clean is not None:
+        for key in ('y_pred', 'label', 'conf', 'x_norm'):
+            results[key] = clean[key]
     with torch.no_grad():
-        for images, labels in test_loader:
-            images = images.to(device)
-            labels = labels.to(device)
-            outputs = model(images)
-            _, predicted = torch.max(outputs.data, 1)
-            predictions = torch.softmax(outputs.data, dim=1).detach().numpy()
-            correct += predicted.eq(labels.data.view_as(predicted)).sum().item()
-            y_pred += predictions.tolist()
-        accuracy = 1. * correct / len(test_loader.dataset)
-    y_pred = np.array(y_pred)
-    return accuracy, y_pred
-
-
-def get_perturbation_metric(x_original, x_adv, y_pred, y_pred_adv, ord=2):
-    idxs = (np.argmax(y_pred_adv, axis=1) != np.argmax(y_pred, axis=1))
-
-    if np.sum(idxs) == 0.0:
-        return 0
-
-    perts_norm = la.norm((x_adv - x_original).reshape(x_original.shape[0], -1), ord, axis=1)
-    perts_norm = perts_norm[idxs]
+        for start in range(0, n, batch_size):
+            end = min(start + batch_size, n)
+            rows = end - start
+            images = torch.from_numpy(np.ascontiguousarray(x_original[start:end], dtype=np.float32))
+            images_adv = torch.from_numpy(np.ascontiguousarray(x_adv[start:end], dtype=np.float32))
+            if clean is None:
+                outputs = model(torch.cat([images, images_adv]).to(device))
+            else:
+                outputs = model(images_adv.to(device))
+            predictions = torch.softmax(outputs, dim=1).cpu()
+            confidence, predicted = torch.max(predictions, 1)
+            if results['y_pred_adv'] is None:
+                results['y_pred_adv'] = np.empty((n, predictions.shape[1]), dtype=np.float32)
+
+            offset = 0
+            if clean is None:
+                if results['y_pred'] is None:
+                    results['y_pred'] = np.empty((n, predictions.shape[1]), dtype=np.float32)
+                results['y_pred'][start:end] = predictions[:rows].numpy()
+                results['label'][start:end] = predicted[:rows].numpy()
+                results['conf'][start:end] = confidence[:rows].numpy()
+                offset = rows
+            results['y_pred_adv'][start:end] = predictions[offset:].numpy()
+            results['label_adv'][start:end] = predicted[offset:].numpy()
+            results['conf_adv'][start:end] = confidence[offset:].numpy()
+            flat = images.reshape(rows, -1)
+            results['pert_norm'][start:end] = torch.norm(images_adv.reshape(rows, -1) - flat, p=ord, dim=1).numpy()
+            if clean is None:
+                results['x_norm'][start:end] = torch.norm(flat, p=ord, dim=1).numpy()
+    return results
+
+
+def clean_results(softmax, x_original, ord=2):
+    """
+    The clean buffers of evaluate_fused built from stored softmax outputs of
+    the model on x_original, so that only the adversarial inputs need a
+    forward pass.
+    """
+    softmax = np.asarray(softmax, dtype=np.float32)
+    flat = np.asarray(x_original, dtype=np.float32).reshape(x_original.shape[0], -1)
+    return {
+        'y_pred': softmax,
+        'label': np.argmax(softmax, axis=1),
+        'conf': np.max(softmax, axis=1),
+        'x_norm': la.norm(flat, ord=ord, axis=1).astype(np.float32)
+    }
 
-    return np.mean(perts_norm / la.norm(x_original[idxs].reshape(np.sum(idxs), -1), ord, axis=1))
 
+class RobustnessAccumulator():
+    """
+    Running totals for the metrics reported by get_metrics. The results of
+    evaluate_fused are folded in one chunk at a time, so only one chunk of
+    inputs and predictions has to be held in memory.
+
+    With bootstrap_resamples > 0 the accumulator also keeps Poisson bootstrap
+    totals: every sample gets an independent Poisson(1) weight in each
+    resample, and the weighted per-sample values are summed with one matrix
+    product per block of samples. This streams like the plain totals and
+    yields percentile confidence intervals for every metric.
+    """
+    COUNTERS = ('count', 'correct', 'correct_adv', 'same_class', 'conf_reduction_sum', 'conf_reduction_count',
+                'pert_sum', 'pert_count', 'bootstrap_sums')
+
+    def __init__(self, bootstrap_resamples=0, confidence_level=0.95, seed=None):
+        self.count = 0
+        self.correct = 0
+        self.correct_adv = 0
+        self.same_class = 0
+        self.conf_reduction_sum = 0.0
+        self.conf_reduction_count = 0
+        self.pert_sum = 0.0
+        self.pert_count = 0
+        self.bootstrap_resamples = bootstrap_resamples
+        self.confidence_level = confidence_level
+        # columns: weight, correct, correct_adv, conf count, conf reduction, pert count, pert ratio
+        self.bootstrap_sums = np.zeros((bootstrap_resamples, 7))
+        self._rng = np.random.RandomState(seed)
+
+    def update(self, results, y):
+        """ Fold in the buffers returned by evaluate_fused for one chunk of inputs. """
+        label = results['label']
+        label_adv = results['label_adv']
+        self.count += y.shape[0]
+        self.correct += int(np.sum(label == y))
+        self.correct_adv += int(np.sum(label_adv == y))
+
+        same = (label == label_adv)
+        self.same_class += int(np.sum(same))
+        conf = results['conf'].astype(np.float64)
+        conf_adv = results['conf_adv'].astype(np.float64)
+        conf_idxs = same & (conf != 0)
+        conf_reduction = np.zeros(y.shape[0])
+        conf_reduction[conf_idxs] = (conf[conf_idxs] - conf_adv[conf_idxs]) / conf[conf_idxs]
+        self.conf_reduction_sum += float(np.sum(conf_reduction))
+        self.conf_reduction_count += int(np.sum(conf_idxs))
+
+        pert_idxs = ~same
+        pert_ratio = np.zeros(y.shape[0])
+        pert_ratio[pert_idxs] = results['pert_norm'][pert_idxs].astype(np.float64) / results['x_norm'][pert_idxs]
+        self.pert_sum += float(np.sum(pert_ratio))
+        self.pert_count += int(np.sum(pert_idxs))
+
+        if self.bootstrap_resamples:
+            values = np.stack([np.ones(y.shape[0]), label == y, label_adv == y,
+                               conf_idxs, conf_reduction, pert_idxs, pert_ratio], axis=1).astype(np.float64)
+            block = 4096
+            for start in range(0, y.shape[0], block):
+                weights = self._rng.poisson(1.0, size=(self.bootstrap_resamples, values[start:start + block].shape[0]))
+                self.bootstrap_sums += weights.dot(values[start:start + block])
+
+    def merge(self, other):
+        """ Add the totals of an accumulator filled from a disjoint part of the test set. """
+        for key in self.COUNTERS:
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+
+    def confidence_intervals(self):
+        sums = self.bootstrap_sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resampled = {
+                "model accuracy on test data": sums[:, 1] / sums[:, 0],
+                "model accuracy on adversarial samples": sums[:, 2] / sums[:, 0],
+                "confidence reduced on correctly classified adv_samples":
+                    np.where(sums[:, 3] > 0, sums[:, 4] / sums[:, 3], 0.),
+                "average perturbation on misclassified adv_samples":
+                    np.where(sums[:, 5] > 0, sums[:, 6] / sums[:, 5], 0.)
+            }
+        tail = 100. * (1. - self.confidence_level) / 2.
+        return {name: [float(np.nanpercentile(values, tail)), float(np.nanpercentile(values, 100. - tail))]
+                for name, values in resampled.items()}
+
+    def metrics(self):
+        conf_metric = 0
+        if self.same_class and self.conf_reduction_count:
+            conf_metric = self.conf_reduction_sum / self.conf_reduction_count
+        pert_metric = 0
+        if self.pert_count:
+            pert_metric = self.pert_sum / self.pert_count
+        # the accuracies of an empty test set are undefined
+        count = self.count or float('nan')
+        metrics = {
+            "model accuracy on test data": float(self.correct) / count,
+            "model accuracy on adversarial samples": float(self.correct_adv) / count,
+            "confidence reduced on correctly classified adv_samples": float(conf_metric),
+            "average perturbation on misclassified adv_samples": float(pert_metric)
+        }
+        if self.bootstrap_resamples:
+            metrics["confidence intervals"] = self.confidence_intervals()
+            metrics["confidence level"] = self.confidence_level
+        return metrics
+
+
+def get_metrics_streaming(model, crafter, x, y, chunk_size=256, progress=None, bootstrap_resamples=0,
+                          softmax=None):
+    """
+    Craft adversarial samples and compute the get_metrics report chunk by
+    chunk. x can be a memory-mapped array; peak memory is bounded by
+    chunk_size rather than by the size of the test set. softmax, if given,
+    holds the clean model outputs on x.
+    """
+    accumulator = RobustnessAccumulator(bootstrap_resamples)
+    for start in range(0, x.shape[0], chunk_size):
+        x_chunk = np.asarray(x[start:start + chunk_size], dtype=np.float32)
+        y_chunk = np.asarray(y[start:start + chunk_size])
+        x_adv_chunk = crafter.generate(x_chunk)
+        clean = None if softmax is None else clean_results(softmax[start:start + chunk_size], x_chunk)
+        accumulator.update(evaluate_fused(model, x_chunk, x_adv_chunk, clean=clean), y_chunk)
+        if progress:
+            progress('attacking', float(start + x_chunk.shape[0]) / x.shape[0])
+    return accumulator.metrics()
+
+
+def load_classifier(object_storage_url, object_storage_username, object_storage_password,
+                    data_bucket_name, result_bucket_name, model_id,
+                    feature_testset_path='processed_data/X_test.npy',
+                    label_testset_path='processed_data/y_test.npy',
+                    clip_values=(0, 1),
+                    nb_classes=2,
+                    input_shape=(1, 3, 64, 64),
+                    model_class_file='model.py',
+                    model_class_name='model',
+                    LossFn='',
+                    Optimizer='',
+                    mmap_mode=None):
+    """
+    Download the test set and the trained model, and wrap the model in an ART
+    classifier. Returns (model, classifier, x, y, softmax), where softmax are
+    the clean model outputs on x, shared with the other checks through the
+    results bucket (see prediction_cache).
+    """
+    url = re.compile(r"https?://")
+    cos = Minio(url.sub('', object_storage_url),
+                access_key=object_storage_username,
+                secret_key=object_storage_password)
 
-# This computes the change in confidence for all images in the test set
-def get_confidence_metric(y_pred, y_pred_adv):
-    y_classidx = np.argmax(y_pred, axis=1)
-    y_classconf = y_pred[np.arange(y_pred.shape[0]), y_classidx]
+    dataset_filenamex, dataset_filenamey = artifact_cache.fetch_all(cos, [
+        (data_bucket_name, feature_testset_path),
+        (data_bucket_name, label_testset_path)
+    ])
 
-    y_adv_classidx = np.argmax(y_pred_adv, axis=1)
-    y_adv_classconf = y_pred_adv[np.arange(y_pred_adv.shape[0]), y_adv_classidx]
+    # The registry only downloads, imports and loads the model on first use.
+    model = model_registry.default_registry().get(cos, result_bucket_name, model_id,
+                                                  model_class_file=model_class_file,
+                                                  model_class_name=model_class_name)
 
-    idxs = (y_classidx == y_adv_classidx)
+    # Define Loss and optimizer function for the PyTorch model
+    if LossFn:
+        loss_fn = eval(LossFn)
+    else:
+        loss_fn = torch.nn.CrossEntropyLoss()
+    if Optimizer:
+        optimizer = eval(Optimizer)
+    else:
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
 
-    if np.sum(idxs) == 0.0:
-        return 0
+    # create pytorch classifier
+    classifier = PyTorchClassifier(clip_values, model, loss_fn, optimizer, input_shape, nb_classes)
 
-    idxnonzero = y_classconf != 0
-    idxs = idxs & idxnonzero
+    # load test dataset, either a .npy file or the index.json of a sharded dataset
+    if sharded_dataset.is_sharded(feature_testset_path):
+        x = sharded_dataset.open_sharded_object(cos, data_bucket_name, feature_testset_path, artifact_cache.fetch)
+        # fetch every shard now, before attack workers are forked off this process
+        x.prefetch()
+        if mmap_mode is None:
+            x = np.asarray(x)
+    else:
+        x = np.load(dataset_filenamex, mmap_mode=mmap_mode)
+    y = np.load(dataset_filenamey, mmap_mode=mmap_mode)
 
-    return np.mean((y_classconf[idxs] - y_adv_classconf[idxs]) / y_classconf[idxs])
+    _, softmax = prediction_cache.get_predictions(cos, data_bucket_name, result_bucket_name, model_id,
+                                                  feature_testset_path, x, lambda: model,
+                                                  model_class_file=model_class_file,
+                                                  model_class_name=model_class_name)
+    return model, classifier, x, y, softmax
 
 
 def robustness_check(object_storage_url, object_storage_username, object_storage_password,
@@ -110,64 +315,212 @@ def robustness_check(object_storage_url, object_storage_username, object_storage
                      model_class_name='model',
                      LossFn='',
                      Optimizer='',
-                     epsilon=0.2):
-
-    url = re.compile(r"https?://")
-    cos = Minio(url.sub('', object_storage_url),
-                access_key=object_storage_username,
-                secret_key=object_storage_password)
+                     epsilon=0.2,
+                     chunk_size=0,
+                     workers=1,
+                     bootstrap_resamples=0,
+                     progress=None):
+    """
+    Run the FGSM robustness check. progress, if given, is called with the
+    current phase and the fraction of the test set processed so far.
+    bootstrap_resamples > 0 adds bootstrap confidence intervals to the report.
+    """
+    if progress:
+        progress('loading')
+    # memory-map the test set when it is crafted/evaluated one chunk at a time
+    model, classifier, x, y, softmax = load_classifier(object_storage_url, object_storage_username, object_storage_password,
+                                                   data_bucket_name, result_bucket_name, model_id,
+                                                   feature_testset_path=feature_testset_path,
+                                                   label_testset_path=label_testset_path,
+                                                   clip_values=clip_values,
+                                                   nb_classes=nb_classes,
+                                                   input_shape=input_shape,
+                                                   model_class_file=model_class_file,
+                                                   model_class_name=model_class_name,
+                                                   LossFn=LossFn,
+                                                   Optimizer=Optimizer,
+                                                   mmap_mode='r' if chunk_size else None)
 
-    dataset_filenamex = "X_test.npy"
-    dataset_filenamey = "y_test.npy"
-    weights_filename = "model.pt"
-    model_files = model_id + '/_submitted_code/model.zip'
-
-    cos.fget_object(data_bucket_name, feature_testset_path, dataset_filenamex)
-    cos.fget_object(data_bucket_name, label_testset_path, dataset_filenamey)
-    cos.fget_object(result_bucket_name, model_id + '/' + weights_filename, weights_filename)
-    cos.fget_object(result_bucket_name, model_files, 'model.zip')
-
-    # Load PyTorch model definition from the source code.
-    zip_ref = zipfile.ZipFile('model.zip', 'r')
-    zip_ref.extractall('model_files')
-    zip_ref.close()
-
-    modulename = 'model_files.' + model_class_file.split('.')[0].replace('-', '_')
-
-    '''
-    We required users to define where the model class is located or follow
-    some naming convention we have provided.
-    '''
-    model_class = getattr(importlib.import_module(modulename), model_class_name)
-
-    # load & compile model
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    model = model_class().to(device)
-    model.load_state_dict(torch.load(weights_filename, map_location=device))
-
-    # Define Loss and optimizer function for the PyTorch model
-    if LossFn:
-        loss_fn = eval(LossFn)
-    else:
-        loss_fn = torch.nn.CrossEntropyLoss()
-    if Optimizer:
-        optimizer = eval(Optimizer)
+    crafter = FastGradientMethod(classifier, eps=epsilon)
+    if progress:
+        progress('attacking', 0.0)
+
+    if workers > 1:
+        metrics = get_robustness_curve(model, classifier, x, y, attacks=('fgsm',), epsilons=(epsilon,),
+                                       chunk_size=chunk_size, workers=workers, progress=progress,
+                                       bootstrap_resamples=bootstrap_resamples, softmax=softmax)[0]
+        del metrics["attack"], metrics["epsilon"]
+    elif chunk_size:
+        metrics = get_metrics_streaming(model, crafter, x, y, chunk_size=chunk_size, progress=progress,
+                                        bootstrap_resamples=bootstrap_resamples, softmax=softmax)
     else:
-        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
-
-    # create pytorch classifier
-    classifier = PyTorchClassifier(clip_values, model, loss_fn, optimizer, input_shape, nb_classes)
+        # craft adversarial samples using FGSM
+        x_samples = crafter.generate(x)
 
-    # load test dataset
-    x = np.load(dataset_filenamex)
-    y = np.load(dataset_filenamey)
+        # obtain all metrics (robustness score, perturbation metric, reduction in confidence)
+        metrics, y_pred_orig, y_pred_adv = get_metrics(model, x, x_samples, y, bootstrap_resamples=bootstrap_resamples,
+                                                       softmax=softmax)
 
-    # craft adversarial samples using FGSM
-    crafter = FastGradientMethod(classifier, eps=epsilon)
-    x_samples = crafter.generate(x)
+    print("metrics:", metrics)
+    return metrics
 
-    # obtain all metrics (robustness score, perturbation metric, reduction in confidence)
-    metrics, y_pred_orig, y_pred_adv = get_metrics(model, x, x_samples, y)
 
+'''
+Attacks available to robustness_sweep. Each entry builds an ART attack for a
+given epsilon. DeepFool searches for a minimal perturbation rather than taking
+an L-inf budget, so it is run once per sweep and reported without an epsilon.
+'''
+ATTACKS = {
+    'fgsm': lambda classifier, eps: FastGradientMethod(classifier, eps=eps),
+    'pgd': lambda classifier, eps: ProjectedGradientDescent(classifier, eps=eps, eps_step=eps / 4., max_iter=20),
+    'deepfool': lambda classifier, eps: DeepFool(classifier)
+}
+EPSILON_FREE_ATTACKS = ('deepfool',)
+
+
+def _accumulate_curve(model, classifier, x, y, combinations, start, end, chunk_size, progress=None,
+                      bootstrap_resamples=0, softmax=None):
+    points = [(ATTACKS[attack](classifier, epsilon), RobustnessAccumulator(bootstrap_resamples))
+              for attack, epsilon in combinations]
+    chunk_size = chunk_size or (end - start)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        x_chunk = np.asarray(x[chunk_start:chunk_end], dtype=np.float32)
+        y_chunk = np.asarray(y[chunk_start:chunk_end])
+        clean = None if softmax is None else clean_results(softmax[chunk_start:chunk_end], x_chunk)
+        for crafter, accumulator in points:
+            results = evaluate_fused(model, x_chunk, crafter.generate(x_chunk), clean=clean)
+            clean = results
+            accumulator.update(results, y_chunk)
+        if progress:
+            progress('attacking', float(chunk_end - start) / (end - start))
+    return [accumulator for crafter, accumulator in points]
+
+
+# State of a forked attack worker process, set by _init_worker, see get_robustness_curve.
+_worker_state = {}
+
+
+def _init_worker(num_threads, state):
+    torch.set_num_threads(num_threads)
+    _worker_state.update(state)
+
+
+def _accumulate_shard(bounds):
+    state = _worker_state
+    return _accumulate_curve(state['model'], state['classifier'], state['x'], state['y'],
+                             state['combinations'], bounds[0], bounds[1], state['chunk_size'],
+                             bootstrap_resamples=state['bootstrap_resamples'], softmax=state['softmax'])
+
+
+def get_robustness_curve(model, classifier, x, y, attacks=('fgsm',), epsilons=(0.2,), chunk_size=0,
+                         workers=1, threads_per_worker=0, progress=None, bootstrap_resamples=0, softmax=None):
+    """
+    Evaluate every (attack, epsilon) combination over the test set. Clean
+    predictions are computed once per chunk and shared by all combinations,
+    or taken from softmax, the stored clean model outputs on x.
+
+    With workers > 1 the test set is sharded across a pool of forked
+    processes. Each worker inherits its own copy of the model and classifier,
+    crafts and evaluates its shards, and the per-shard accumulators are merged.
+    threads_per_worker caps torch intra-op threads in each worker (by default
+    the available cores are divided evenly between workers). Forking is only
+    safe from a single-threaded process such as the robustness_check.py CLI,
+    so workers > 1 is rejected in a process running other threads, e.g. the
+    service and its jobs.
+    """
+    combinations = []
+    for attack in attacks:
+        if attack not in ATTACKS:
+            raise ValueError('Unknown attack "%s", expected one of %s' % (attack, sorted(ATTACKS)))
+        for epsilon in ([None] if attack in EPSILON_FREE_ATTACKS else epsilons):
+            combinations.append((attack, epsilon))
+
+    if workers > 1 and threading.active_count() > 1:
+        raise ValueError('workers > 1 forks the process, which is unsafe while other threads run in it')
+
+    n = x.shape[0]
+    if workers <= 1:
+        accumulators = _accumulate_curve(model, classifier, x, y, combinations, 0, n, chunk_size, progress=progress,
+                                         bootstrap_resamples=bootstrap_resamples, softmax=softmax)
+    else:
+        threads_per_worker = threads_per_worker or max(1, multiprocessing.cpu_count() // workers)
+        # a few shards per worker so that uneven shards still keep every core busy
+        shard_size = max(1, -(-n // (workers * 4)))
+        shards = [(start, min(start + shard_size, n)) for start in range(0, n, shard_size)]
+
+        # Forked workers inherit the initializer arguments without pickling them. Handing
+        # the state to each pool keeps concurrent sweeps (e.g. jobs) apart.
+        state = dict(model=model, classifier=classifier, x=x, y=y,
+                     combinations=combinations, chunk_size=chunk_size,
+                     bootstrap_resamples=bootstrap_resamples, softmax=softmax)
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=_init_worker,
+                                                        initargs=(threads_per_worker, state))
+        try:
+            shard_accumulators = []
+            for shard in pool.imap(_accumulate_shard, shards):
+                shard_accumulators.append(shard)
+                if progress:
+                    progress('attacking', float(len(shard_accumulators)) / len(shards))
+        finally:
+            pool.close()
+            pool.join()
+
+        accumulators = [RobustnessAccumulator(bootstrap_resamples) for _ in combinations]
+        for shard in shard_accumulators:
+            for accumulator, partial in zip(accumulators, shard):
+                accumulator.merge(partial)
+
+    curve = []
+    for (attack, epsilon), accumulator in zip(combinations, accumulators):
+        point = {"attack": attack, "epsilon": epsilon}
+        point.update(accumulator.metrics())
+        curve.append(point)
+    return curve
+
+
+def robustness_sweep(object_storage_url, object_storage_username, object_storage_password,
+                     data_bucket_name, result_bucket_name, model_id,
+                     feature_testset_path='processed_data/X_test.npy',
+                     label_testset_path='processed_data/y_test.npy',
+                     clip_values=(0, 1),
+                     nb_classes=2,
+                     input_shape=(1, 3, 64, 64),
+                     model_class_file='model.py',
+                     model_class_name='model',
+                     LossFn='',
+                     Optimizer='',
+                     attacks=('fgsm',),
+                     epsilons=(0.2,),
+                     chunk_size=0,
+                     workers=1,
+                     bootstrap_resamples=0,
+                     progress=None):
+    """
+    Like robustness_check, but downloads and loads everything once and then
+    runs all requested attacks and epsilons, returning a robustness curve.
+    """
+    if progress:
+        progress('loading')
+    model, classifier, x, y, softmax = load_classifier(object_storage_url, object_storage_username, object_storage_password,
+                                                   data_bucket_name, result_bucket_name, model_id,
+                                                   feature_testset_path=feature_testset_path,
+                                                   label_testset_path=label_testset_path,
+                                                   clip_values=clip_values,
+                                                   nb_classes=nb_classes,
+                                                   input_shape=input_shape,
+                                                   model_class_file=model_class_file,
+                                                   model_class_name=model_class_name,
+                                                   LossFn=LossFn,
+                                                   Optimizer=Optimizer,
+                                                   mmap_mode='r' if chunk_size else None)
+
+    curve = get_robustness_curve(model, classifier, x, y, attacks=attacks, epsilons=epsilons,
+                                 chunk_size=chunk_size, workers=workers, progress=progress,
+                                 bootstrap_resamples=bootstrap_resamples, softmax=softmax)
+    metrics = {
+        "model accuracy on test data": curve[0]["model accuracy on test data"] if curve else None,
+        "robustness curve": curve
+    }
     print("metrics:", metrics)
     return metrics
@@ -12,9 +12,28 @@
 # See the License for the specific language governing permissions and 
 # limitations under the License. 
 import json
+import math
 import argparse
 
-from robustness import robustness_check
+from robustness import robustness_check, robustness_sweep
+
+def adversarial_accuracy(metrics, ci_gate='none'):
+    """
+    Adversarial accuracy compared against the robustness threshold. With
+    bootstrap confidence intervals, ci_gate 'lenient' uses the upper bound
+    (fail only when the whole interval is below the threshold) and 'strict'
+    the lower bound (fail when any part of it is). A non-finite accuracy or
+    bound, e.g. of an empty test set, counts as 0 and so fails the check.
+    """
+    name = 'model accuracy on adversarial samples'
+    if ci_gate == 'none' or 'confidence intervals' not in metrics:
+        accuracy = metrics[name]
+    else:
+        lower, upper = metrics['confidence intervals'][name]
+        if not (math.isfinite(lower) and math.isfinite(upper)):
+            return 0.0
+        accuracy = upper if ci_gate == 'lenient' else lower
+    return accuracy if math.isfinite(accuracy) else 0.0
 
 def get_secret(path):
     with open(path, 'r') as f:
@@ -35,8 +54,14 @@ if __name__ == "__main__":
     parser.add_argument('--clip_values', type=str, help='pytorch model clip_values allowed for features (min, max)', default="(0,1)")
     parser.add_argument('--nb_classes', type=int, help='The number of classes of the model', default=2)
     parser.add_argument('--input_shape', type=str, help='The shape of one input instance for the pytorch model', default="(1,3,64,64)")
-    parser.add_argument('--feature_testset_path', type=str, help='Feature test dataset path in the data bucket', default="processed_data/X_test.npy")
+    parser.add_argument('--feature_testset_path', type=str, help='Feature test dataset path in the data bucket, a .npy file or the index.json of a sharded dataset', default="processed_data/X_test.npy")
     parser.add_argument('--label_testset_path', type=str, help='Label test dataset path in the data bucket', default="processed_data/y_test.npy")
+    parser.add_argument('--chunk_size', type=int, help='Craft and evaluate adversarial samples in chunks of this many rows (0 loads the whole test set)', default=0)
+    parser.add_argument('--epsilons', type=str, help='Comma separated epsilon values to sweep, e.g. "0.05,0.1,0.2". Runs a robustness curve instead of a single check', default="")
+    parser.add_argument('--attacks', type=str, help='Comma separated attacks to sweep over (fgsm, pgd, deepfool)', default="fgsm")
+    parser.add_argument('--workers', type=int, help='Number of processes generating adversarial samples in parallel', default=1)
+    parser.add_argument('--bootstrap_resamples', type=int, help='Number of bootstrap resamples for metric confidence intervals (0 disables them)', default=0)
+    parser.add_argument('--ci_gate', type=str, help='Decide the robust status on the point estimate (none) or on the confidence interval bounds (lenient, strict)', choices=['none', 'lenient', 'strict'], default="none")
     args = parser.parse_args()
 
     epsilon = args.epsilon
@@ -52,6 +77,16 @@ if __name__ == "__main__":
     label_testset_path = args.label_testset_path
     clip_values = eval(args.clip_values)
     input_shape = eval(args.input_shape)
+    chunk_size = args.chunk_size
+    epsilons = [float(e) for e in args.epsilons.split(',') if e.strip()]
+    attacks = [a.strip() for a in args.attacks.split(',') if a.strip()]
+    workers = args.workers
+    bootstrap_resamples = args.bootstrap_resamples
+    ci_gate = args.ci_gate
+    # the robust status of a sweep is gated on the epsilon budget attacks up to --epsilon
+    if epsilons and (not [e for e in epsilons if e <= epsilon] or not [a for a in attacks if a != 'deepfool']):
+        parser.error('--epsilons needs a value <= --epsilon and --attacks an attack other than deepfool '
+                     'to decide the robust status')
 
     object_storage_url = get_secret('/app/secrets/s3_url')
     data_bucket_name = get_secret('/app/secrets/training_bucket')
@@ -59,24 +94,51 @@ if __name__ == "__main__":
     object_storage_username = get_secret('/app/secrets/s3_access_key_id')
     object_storage_password = get_secret('/app/secrets/s3_secret_access_key')
 
-    metrics = robustness_check(object_storage_url, object_storage_username, object_storage_password,
-                               data_bucket_name, result_bucket_name, model_id,
-                               feature_testset_path=feature_testset_path,
-                               label_testset_path=label_testset_path,
-                               clip_values=clip_values,
-                               nb_classes=nb_classes,
-                               input_shape=input_shape,
-                               model_class_file=model_class_file,
-                               model_class_name=model_class_name,
-                               LossFn=LossFn,
-                               Optimizer=Optimizer,
-                               epsilon=epsilon)
+    if epsilons:
+        metrics = robustness_sweep(object_storage_url, object_storage_username, object_storage_password,
+                                   data_bucket_name, result_bucket_name, model_id,
+                                   feature_testset_path=feature_testset_path,
+                                   label_testset_path=label_testset_path,
+                                   clip_values=clip_values,
+                                   nb_classes=nb_classes,
+                                   input_shape=input_shape,
+                                   model_class_file=model_class_file,
+                                   model_class_name=model_class_name,
+                                   LossFn=LossFn,
+                                   Optimizer=Optimizer,
+                                   attacks=attacks,
+                                   epsilons=epsilons,
+                                   chunk_size=chunk_size,
+                                   workers=workers,
+                                   bootstrap_resamples=bootstrap_resamples)
+        # the status gate only considers budgets up to --epsilon
+        gated = [point for point in metrics['robustness curve']
+                 if point['epsilon'] is not None and point['epsilon'] <= epsilon]
+        # without a gated point there is no evidence of robustness, so the check fails
+        gated_accuracy = min([adversarial_accuracy(point, ci_gate) for point in gated] or [0.0])
+    else:
+        metrics = robustness_check(object_storage_url, object_storage_username, object_storage_password,
+                                   data_bucket_name, result_bucket_name, model_id,
+                                   feature_testset_path=feature_testset_path,
+                                   label_testset_path=label_testset_path,
+                                   clip_values=clip_values,
+                                   nb_classes=nb_classes,
+                                   input_shape=input_shape,
+                                   model_class_file=model_class_file,
+                                   model_class_name=model_class_name,
+                                   LossFn=LossFn,
+                                   Optimizer=Optimizer,
+                                   epsilon=epsilon,
+                                   chunk_size=chunk_size,
+                                   workers=workers,
+                                   bootstrap_resamples=bootstrap_resamples)
+        gated_accuracy = adversarial_accuracy(metrics, ci_gate)
 
     with open(metric_path, "w") as report:
         report.write(json.dumps(metrics))
 
     robust = "true"
-    if metrics['model accuracy on adversarial samples'] < 0.2:
+    if gated_accuracy < 0.2:
         robust = "false"
 
     with open(robust_status, "w") as report:
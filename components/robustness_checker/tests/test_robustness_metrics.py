@@ -0,0 +1,105 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Streaming robustness metrics, their bootstrap intervals and the robust status gate. """
+import math
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('art')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from robustness import RobustnessAccumulator  # noqa: E402
+from robustness_check import adversarial_accuracy  # noqa: E402
+
+ADVERSARIAL_ACCURACY = 'model accuracy on adversarial samples'
+
+
+def random_results(seed, n=2000):
+    """ Buffers as returned by evaluate_fused, with labels that agree with y more often than not. """
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, 2, n)
+    label = np.where(rng.rand(n) < 0.8, y, 1 - y)
+    label_adv = np.where(rng.rand(n) < 0.6, label, 1 - label)
+    results = {
+        'label': label,
+        'label_adv': label_adv,
+        'conf': rng.uniform(0.5, 1.0, n).astype(np.float32),
+        'conf_adv': rng.uniform(0.5, 1.0, n).astype(np.float32),
+        'pert_norm': rng.uniform(0.0, 1.0, n).astype(np.float32),
+        'x_norm': rng.uniform(1.0, 2.0, n).astype(np.float32)
+    }
+    return results, y
+
+
+def chunk(results, y, start, stop):
+    return {name: values[start:stop] for name, values in results.items()}, y[start:stop]
+
+
+def test_chunks_and_merged_shards_match_a_single_update():
+    results, y = random_results(0)
+    whole = RobustnessAccumulator()
+    whole.update(results, y)
+
+    chunked = RobustnessAccumulator()
+    for start in range(0, len(y), 300):
+        chunked.update(*chunk(results, y, start, start + 300))
+
+    merged = RobustnessAccumulator()
+    for start, stop in ((0, 700), (700, len(y))):
+        shard = RobustnessAccumulator()
+        shard.update(*chunk(results, y, start, stop))
+        merged.merge(shard)
+
+    expected = whole.metrics()
+    assert expected[ADVERSARIAL_ACCURACY] == np.mean(results['label_adv'] == y)
+    for metrics in (chunked.metrics(), merged.metrics()):
+        for name in expected:
+            assert metrics[name] == pytest.approx(expected[name], rel=1e-12), name
+
+
+def test_bootstrap_intervals_contain_the_point_estimates():
+    results, y = random_results(1)
+    accumulator = RobustnessAccumulator(bootstrap_resamples=500, confidence_level=0.9, seed=0)
+    accumulator.update(results, y)
+    metrics = accumulator.metrics()
+    assert metrics["confidence level"] == 0.9
+    intervals = metrics["confidence intervals"]
+    assert sorted(intervals) == sorted(name for name in metrics if name not in ("confidence intervals",
+                                                                                 "confidence level"))
+    for name, (lower, upper) in intervals.items():
+        assert lower <= metrics[name] <= upper, name
+        # roughly +-1.645 standard errors of a proportion over 2000 samples
+        assert upper - lower < 0.1, name
+
+
+def test_an_empty_test_set_has_undefined_accuracies():
+    metrics = RobustnessAccumulator().metrics()
+    assert math.isnan(metrics[ADVERSARIAL_ACCURACY])
+    assert adversarial_accuracy(metrics) == 0.0
+
+
+@pytest.mark.parametrize('ci_gate,expected', [('none', 0.5), ('lenient', 0.6), ('strict', 0.4)])
+def test_gate_uses_the_interval_bound_of_the_ci_gate(ci_gate, expected):
+    metrics = {ADVERSARIAL_ACCURACY: 0.5, 'confidence intervals': {ADVERSARIAL_ACCURACY: [0.4, 0.6]}}
+    assert adversarial_accuracy(metrics, ci_gate) == expected
+
+
+@pytest.mark.parametrize('ci_gate', ['lenient', 'strict'])
+def test_non_finite_interval_bounds_fail_the_gate(ci_gate):
+    for bounds in ([float('nan'), float('nan')], [0.4, float('inf')], [float('nan'), 0.9]):
+        metrics = {ADVERSARIAL_ACCURACY: 0.5, 'confidence intervals': {ADVERSARIAL_ACCURACY: bounds}}
+        assert adversarial_accuracy(metrics, ci_gate) == 0.0
@@ -16,16 +16,27 @@ import PIL
 from PIL import Image
 import numpy as np
 import argparse
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
 
 import torch
 import torch.utils.data
-from torch.autograd import Variable
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torchsummary import summary
 import time
 
 import pandas as pd
 
+from model_export import RUNTIMES, export_all
+from sharded_dataset import INDEX_FILENAME, file_sha256, load_array
+
 np.random.seed(99)
 torch.manual_seed(99)
 
@@ -52,38 +63,419 @@ class ThreeLayerCNN(torch.nn.Module):
         x = self.pool(torch.nn.functional.relu(self.conv1(x)))
         x = self.pool(torch.nn.functional.relu(self.conv2(x)))
         x = self.pool(torch.nn.functional.relu(self.conv3(x)))
-        x = x.view(-1,16*4*4)
+        # reshape rather than view, so that channels_last activations work too
+        x = x.reshape(-1,16*4*4)
         x = torch.nn.functional.relu(self.fc1(x))
         x = self.fc2(x)
         return x
 
 
+class BatchDataset(torch.utils.data.Dataset):
+    """
+    Serves whole batches of an array-like, e.g. a memory-mapped array or a
+    sharded dataset, so that its rows are read, decoded and normalized one
+    batch at a time (in the loader workers, if any). Used with a
+    BatchSampler, which hands over the row indices of a batch. Contiguous
+    batches of float32 arrays are handed to torch as views, without copying.
+    """
+    def __init__(self, X, y):
+        self.X = X
+        self.y = y
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, indices):
+        indices = np.asarray(indices)
+        if len(indices) and indices[-1] - indices[0] == len(indices) - 1 and np.all(np.diff(indices) == 1):
+            rows = self.X[indices[0]:indices[-1] + 1]
+        else:
+            rows = self.X[indices]
+        images = torch.from_numpy(np.asarray(rows, dtype=np.float32))
+        labels = torch.from_numpy(np.asarray(self.y[indices]).astype(np.int64))
+        return images, labels
+
+
+def _init_loader_worker(worker_id):
+    # the main process already uses every core for the model
+    torch.set_num_threads(1)
+
+
+class ResumableBatchSampler(torch.utils.data.BatchSampler):
+    """
+    BatchSampler that can skip the first skip batches of its next pass, to
+    resume an epoch part way without loading the batches already trained on.
+    """
+    skip = 0
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        for idx, batch in enumerate(super().__iter__()):
+            if idx >= skip:
+                yield batch
+
+
+def batch_loader(X, y, batch_size, shuffle, num_workers=0, prefetch_factor=2, pin_memory=False, sampler=None):
+    """
+    DataLoader over BatchDataset batches. With num_workers > 0, persistent
+    worker processes prepare up to prefetch_factor batches each ahead of the
+    training loop. sampler, if given, selects the rows instead of a random or
+    sequential pass over all of them. loader.sampler.skip skips batches at
+    the start of the next pass.
+    """
+    dataset = BatchDataset(X, y)
+    if sampler is None and shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    elif sampler is None:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    options = {}
+    if num_workers:
+        options = {"prefetch_factor": prefetch_factor, "persistent_workers": True,
+                   "worker_init_fn": _init_loader_worker}
+    return torch.utils.data.DataLoader(dataset, batch_size=None,
+                                       sampler=ResumableBatchSampler(sampler, batch_size, drop_last=False),
+                                       num_workers=num_workers, pin_memory=pin_memory, **options)
+
+
+def configure_threads(num_threads=0, interop_threads=0):
+    """ Set torch's intra-op and inter-op thread pools; 0 keeps the default. """
+    if interop_threads:
+        # only possible before any inter-op parallel work has started
+        torch.set_num_interop_threads(interop_threads)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def bf16_supported(device):
+    """
+    bfloat16 autocast only pays off on CPUs with native bfloat16 support
+    (AVX512-BF16 or AMX); elsewhere it is emulated and slower than fp32.
+    """
+    if device.type != 'cpu':
+        return True
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def prepare_model(model, channels_last=False, compile=False):
+    """ Apply the memory format and compilation options to a model. """
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if compile and hasattr(torch, 'compile'):
+        model = torch.compile(model)
+    return model
+
+
+def train_step(model, images, labels, criterion, optimizer, step, accumulation_steps=1, bf16=False,
+               channels_last=False, last=False):
+    """
+    Forward and backward pass of one batch. The optimizer steps once every
+    accumulation_steps batches (and on the last batch), so the gradients of
+    that many batches add up to one larger effective batch.
+    """
+    if channels_last:
+        images = images.contiguous(memory_format=torch.channels_last)
+    if bf16:
+        autocast = torch.autocast(device_type=images.device.type, dtype=torch.bfloat16)
+    else:
+        autocast = contextlib.nullcontext()
+    stepping = (step + 1) % accumulation_steps == 0 or last
+    # a DistributedDataParallel model only needs to average the gradients before a step
+    if stepping or not hasattr(model, 'no_sync'):
+        sync = contextlib.nullcontext()
+    else:
+        sync = model.no_sync()
+    with sync:
+        with autocast:
+            outputs = model(images)
+            loss = criterion(outputs, labels)
+        (loss / accumulation_steps).backward()
+    if stepping:
+        optimizer.step()
+        optimizer.zero_grad()
+    return loss
+
+
+def benchmark(X, y, batch_size, device, steps=20, warmup=5, accumulation_steps=1):
+    """
+    Time training steps of a fresh model with each performance option off
+    and on, on the same batches, and print step time and throughput.
+    """
+    loader = batch_loader(X, y, batch_size, shuffle=False)
+    batches = []
+    for images, labels in loader:
+        batches.append((images.to(device), labels.to(device)))
+        if len(batches) == warmup + steps:
+            break
+    if not batches:
+        print('No training data to benchmark')
+        return
+    # cycle through the batches of a small training set
+    batches = [batches[i % len(batches)] for i in range(warmup + steps)]
+
+    configurations = [
+        ('fp32', {}),
+        ('channels_last', {'channels_last': True}),
+        ('bf16 autocast', {'bf16': True}),
+        ('torch.compile', {'compile': True}),
+        ('all', {'channels_last': True, 'bf16': True, 'compile': True})
+    ]
+    print('Benchmark: {} threads, {} inter-op threads, batch size {}, accumulation steps {}'.format(
+        torch.get_num_threads(), torch.get_num_interop_threads(), batch_size, accumulation_steps))
+    for name, options in configurations:
+        if options.get('bf16') and not bf16_supported(device):
+            print('{:<15} skipped, no native bfloat16 support'.format(name))
+            continue
+        if options.get('compile') and not hasattr(torch, 'compile'):
+            print('{:<15} skipped, torch.compile is not available'.format(name))
+            continue
+        torch.manual_seed(99)
+        model = prepare_model(ThreeLayerCNN().to(device), options.get('channels_last', False),
+                              options.get('compile', False))
+        criterion = nn.CrossEntropyLoss()
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        for idx, (images, labels) in enumerate(batches):
+            if idx == warmup:
+                start = time.time()
+            train_step(model, images, labels, criterion, optimizer, idx, accumulation_steps,
+                       bf16=options.get('bf16', False), channels_last=options.get('channels_last', False))
+        elapsed = time.time() - start
+        print('{:<15} step time {:.2f} ms, throughput {:.1f} samples/sec'.format(
+            name, 1000. * elapsed / steps, sum(labels.shape[0] for _, labels in batches[warmup:]) / elapsed))
+
+
+'''
+Checkpoints are named checkpoint-<epoch>-<batch>.pt after the position in
+training they resume from, so the latest one sorts last. Each holds
+
+    {"model": ..., "optimizer": ..., "epoch": 2, "step": 300,
+     "world_size": 1, "rng": {"torch": ..., "cuda": ..., "numpy": ..., "python": ...},
+     "sampler": {"epoch": 2, "generator": ...}, "fingerprint": "..."}
+
+where step counts the batches of epoch already trained on, and the sampler
+generator state is the one the epoch's shuffle was drawn from. A run only
+resumes from a checkpoint with its own fingerprint (see run_fingerprint),
+and removes its checkpoints once the trained model is saved, so a finished
+run is never resumed.
+'''
+CHECKPOINT_PATTERN = 'checkpoint-%04d-%06d.pt'
+
+
+def list_checkpoints(checkpoint_dir):
+    """ Checkpoint paths in checkpoint_dir, oldest first. """
+    return sorted(glob.glob(os.path.join(checkpoint_dir, 'checkpoint-*.pt')))
+
+
+def run_fingerprint(data_dir, config):
+    """
+    Hash of the training data and of the config dict of hyperparameters. A
+    sharded dataset is identified by its index, which holds the checksum of
+    every shard, and an .npy file by its contents.
+    """
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8'))
+    for name in ('X_train', 'y_train'):
+        index_path = os.path.join(data_dir, name, INDEX_FILENAME)
+        if os.path.exists(index_path):
+            digest.update(file_sha256(index_path).encode('utf-8'))
+        else:
+            digest.update(file_sha256(os.path.join(data_dir, name + '.npy')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def remove_checkpoints(checkpoint_dir):
+    for path in list_checkpoints(checkpoint_dir):
+        os.remove(path)
+
+
+def _to_cpu(value):
+    """ Copy of a (nested) state dict with its tensors cloned to the CPU. """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: _to_cpu(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_cpu(item) for item in value)
+    return value
+
+
+def checkpoint_state(net, optimizer, epoch, step, world_size, sampler_state, fingerprint):
+    """ Snapshot of everything needed to resume training at batch step of epoch. """
+    rng = {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "numpy": np.random.get_state(),
+        "python": random.getstate()
+    }
+    return _to_cpu({
+        "model": net.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "epoch": epoch,
+        "step": step,
+        "world_size": world_size,
+        "rng": rng,
+        "sampler": {"epoch": epoch, "generator": sampler_state},
+        "fingerprint": fingerprint
+    })
+
+
+def restore_rng(rng):
+    torch.set_rng_state(rng['torch'])
+    if rng['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+    np.random.set_state(rng['numpy'])
+    random.setstate(rng['python'])
+
+
+class CheckpointWriter():
+    """
+    Writes checkpoints in a background thread, so that the training loop only
+    waits for the state to be copied, not for it to be serialized and
+    written. A checkpoint is written to a temporary file and renamed, so
+    checkpoint files are always complete; only the latest keep are kept.
+    """
+    def __init__(self, checkpoint_dir, keep=2):
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self._error = None
+        # at most one checkpoint waits while another one is being written
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, state = item
+            try:
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                for old in list_checkpoints(self.checkpoint_dir)[:-self.keep]:
+                    os.remove(old)
+            except Exception as e:
+                print('Writing checkpoint ' + path + ' failed: ' + str(e))
+                self._error = e
+
+    def save(self, state):
+        if self._error is not None:
+            raise self._error
+        path = os.path.join(self.checkpoint_dir, CHECKPOINT_PATTERN % (state['epoch'], state['step']))
+        self._queue.put((path, state))
+
+    def close(self):
+        """ Wait for the pending checkpoints to be written. """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, help='Dataset directory path')
     parser.add_argument('--result_path', type=str, help='Result model path')
+    parser.add_argument('--mmap', action='store_true', help='Memory-map .npy inputs instead of reading them into memory')
+    parser.add_argument('--num_workers', type=int, help='Number of data loader worker processes', default=0)
+    parser.add_argument('--prefetch_factor', type=int, help='Number of batches prefetched by each data loader worker', default=2)
+    parser.add_argument('--num_threads', type=int, help='Number of torch intra-op threads (0 keeps the default)', default=0)
+    parser.add_argument('--interop_threads', type=int, help='Number of torch inter-op threads (0 keeps the default)', default=0)
+    parser.add_argument('--bf16', action='store_true', help='Train under bfloat16 autocast where the CPU supports it natively')
+    parser.add_argument('--channels_last', action='store_true', help='Use the channels_last memory format for the model and inputs')
+    parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile when available')
+    parser.add_argument('--accumulation_steps', type=int, help='Number of batches whose gradients are accumulated per optimizer step', default=1)
+    parser.add_argument('--benchmark', action='store_true', help='Print step time and throughput with each performance option off and on, then exit')
+    parser.add_argument('--backend', type=str, help='torch.distributed backend used when launched by torchrun with several processes', default="gloo")
+    parser.add_argument('--checkpoint_dir', type=str, help='Checkpoint directory, training resumes from the latest checkpoint in it. Only the first process reads and writes it (default: checkpoints/ next to result_path)', default="")
+    parser.add_argument('--checkpoint_every', type=int, help='Also checkpoint every this many batches, besides at the end of each epoch (0 for epoch ends only)', default=0)
+    parser.add_argument('--keep_checkpoints', type=int, help='Number of latest checkpoints kept', default=2)
+    parser.add_argument('--export', type=str, help='Comma separated inference artifacts written next to result_path: torchscript, int8, onnx (needs the onnx and onnxruntime packages)', default="")
+    parser.add_argument('--quantization', type=str, help='int8 quantization: dynamic (Linear layers) or static (calibrated on training batches, convolutions too)', choices=['dynamic', 'static'], default="dynamic")
+    parser.add_argument('--export_method', type=str, help='Build TorchScript by tracing or scripting the model', choices=['trace', 'script'], default="trace")
     args = parser.parse_args()
+    export_runtimes = [runtime.strip() for runtime in args.export.split(',') if runtime.strip()]
+    for runtime in export_runtimes:
+        if runtime not in RUNTIMES[1:]:
+            parser.error('--export takes a comma separated list of ' + ', '.join(RUNTIMES[1:]))
+    if args.checkpoint_every % args.accumulation_steps:
+        parser.error('--checkpoint_every must be a multiple of --accumulation_steps')
+    if args.keep_checkpoints < 1:
+        parser.error('--keep_checkpoints must be at least 1')
+    configure_threads(args.num_threads, args.interop_threads)
+
+    '''
+    Distributed data-parallel training runs when the script is launched with
+    several processes by torchrun, e.g. locally
+        torchrun --nproc_per_node 2 gender_classification_training.py ...
+    or across pods with --nnodes/--node_rank/--master_addr. torchrun sets the
+    RANK and WORLD_SIZE environment variables read here.
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    distributed = world_size > 1
+    rank = int(os.environ.get('RANK', 0))
+    if distributed:
+        if args.benchmark:
+            parser.error('--benchmark runs in a single process, launch it without torchrun')
+        dist.init_process_group(backend=args.backend)
 
     image_dir = args.data_dir
     result_dir = args.result_path
+    num_workers = args.num_workers
 
     img_size = 64
     batch_size = 64
 
-    X_train = np.load(image_dir + '/X_train.npy')
+    # X_train/X_test are either .npy files or sharded datasets decoded per batch.
+    # Copy-on-write maps give writable views that torch can share without copying.
+    mmap_mode = 'c' if args.mmap else None
+    X_train = load_array(image_dir, 'X_train', mmap_mode=mmap_mode)
     y_train = np.load(image_dir + '/y_train.npy')
-    X_test = np.load(image_dir + '/X_test.npy')
+    X_test = load_array(image_dir, 'X_test', mmap_mode=mmap_mode)
     y_test = np.load(image_dir + '/y_test.npy')
 
-    train = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_train.astype('float32'))), Variable(torch.LongTensor(y_train.astype('float32'))))
-    train_loader = torch.utils.data.DataLoader(train, batch_size=batch_size, shuffle=True)
-    test = torch.utils.data.TensorDataset(Variable(torch.FloatTensor(X_test.astype('float32'))), Variable(torch.LongTensor(y_test.astype('float32'))))
-    test_loader = torch.utils.data.DataLoader(test, batch_size=batch_size, shuffle=False)
-
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    model = ThreeLayerCNN().to(device)
-    summary(model, (3, img_size, img_size))
+    pin_memory = device.type == 'cuda'
+    test_sampler = None
+    # the shuffle of an epoch depends only on the sampler's own state, so a
+    # checkpoint can restore it to resume the epoch part way
+    shuffle_generator = None
+    if distributed:
+        # every process trains on its own 1/world_size of the rows, reshuffled each epoch,
+        # and evaluates a disjoint 1/world_size of the test set
+        train_sampler = torch.utils.data.distributed.DistributedSampler(range(len(X_train)), shuffle=True, seed=99)
+        test_sampler = range(rank, len(X_test), world_size)
+    else:
+        shuffle_generator = torch.Generator()
+        shuffle_generator.manual_seed(99)
+        train_sampler = torch.utils.data.RandomSampler(range(len(X_train)), generator=shuffle_generator)
+    train_loader = batch_loader(X_train, y_train, batch_size, shuffle=True, num_workers=num_workers,
+                                prefetch_factor=args.prefetch_factor, pin_memory=pin_memory, sampler=train_sampler)
+    test_loader = batch_loader(X_test, y_test, batch_size, shuffle=False, num_workers=num_workers,
+                               prefetch_factor=args.prefetch_factor, pin_memory=pin_memory, sampler=test_sampler)
+
+    if args.benchmark:
+        benchmark(X_train, y_train, batch_size, device, accumulation_steps=args.accumulation_steps)
+        raise SystemExit(0)
+
+    bf16 = args.bf16
+    if bf16 and not bf16_supported(device):
+        print('No native bfloat16 support on this CPU, training in fp32')
+        bf16 = False
+    accumulation_steps = args.accumulation_steps
+
+    net = ThreeLayerCNN().to(device)
+    if rank == 0:
+        summary(net, (3, img_size, img_size))
+    model = prepare_model(net, channels_last=args.channels_last)
+    if distributed:
+        # DDP broadcasts rank 0's initial weights and averages gradients across processes
+        model = DistributedDataParallel(model)
+    model = prepare_model(model, compile=args.compile)
 
     """ Training the network """
 
@@ -95,38 +487,135 @@ if __name__ == "__main__":
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
 
+    # Resume from the latest checkpoint. Only rank 0 reads checkpoint_dir and
+    # broadcasts the checkpoint, so the other nodes need no access to it.
+    checkpoint_dir = args.checkpoint_dir or os.path.join(os.path.dirname(os.path.abspath(result_dir)), 'checkpoints')
+    fingerprint = None
+    checkpoints = [None, None, None]
+    if rank == 0:
+        fingerprint = run_fingerprint(image_dir, {
+            "model": type(net).__name__, "batch_size": batch_size, "learning_rate": learning_rate,
+            "num_epochs": num_epochs, "accumulation_steps": accumulation_steps, "bf16": bf16,
+            "channels_last": args.channels_last
+        })
+        latest = list_checkpoints(checkpoint_dir)[-1:]
+        if latest:
+            checkpoint = torch.load(latest[0], map_location='cpu', weights_only=False)
+            if checkpoint.get('fingerprint') == fingerprint:
+                checkpoints = [latest[0], checkpoint, None]
+            else:
+                checkpoints[2] = ('{} was written for other training data or hyperparameters, remove it or '
+                                  'pass another --checkpoint_dir'.format(latest[0]))
+            del checkpoint
+    if distributed:
+        dist.broadcast_object_list(checkpoints)
+    if checkpoints[2]:
+        raise ValueError(checkpoints[2])
+    start_epoch = 0
+    start_step = 0
+    sampler_state = None
+    if checkpoints[1]:
+        checkpoint = checkpoints[1]
+        net.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        restore_rng(checkpoint['rng'])
+        start_epoch = checkpoint['epoch']
+        sampler_state = checkpoint['sampler']['generator']
+        # batches of another number of processes are different rows, so that epoch starts over
+        if checkpoint['world_size'] == world_size:
+            start_step = checkpoint['step']
+        if rank == 0:
+            print('Resuming from {} at epoch {}, step {}'.format(checkpoints[0], start_epoch + 1, start_step))
+        del checkpoint, checkpoints
+    writer = CheckpointWriter(checkpoint_dir, keep=args.keep_checkpoints) if rank == 0 else None
+
     # Start training the model
     num_batches = len(train_loader)
-    for epoch in range(num_epochs):
-        for idx, (images, labels) in enumerate(train_loader):
-            images = images.to(device)
-            labels = labels.to(device)
+    for epoch in range(start_epoch, num_epochs):
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        else:
+            if sampler_state is not None:
+                shuffle_generator.set_state(sampler_state)
+            sampler_state = shuffle_generator.get_state()
+        skip = start_step if epoch == start_epoch else 0
+        train_loader.sampler.skip = skip
+        epoch_start = time.time()
+        wait_time = 0.0
+        samples = 0
+        wait_start = time.time()
+        for idx, (images, labels) in enumerate(train_loader, start=skip):
+            wait_time += time.time() - wait_start
+            images = images.to(device, non_blocking=pin_memory)
+            labels = labels.to(device, non_blocking=pin_memory)
 
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            loss = train_step(model, images, labels, criterion, optimizer, idx, accumulation_steps, bf16=bf16,
+                              channels_last=args.channels_last, last=idx + 1 == num_batches)
 
-            if (idx+1) % print_freq == 0:
+            if (idx+1) % print_freq == 0 and rank == 0:
                 print ('Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}' .format(epoch+1, num_epochs, idx+1, num_batches, loss.item()))
+            samples += labels.shape[0]
+            if args.checkpoint_every and (idx+1) % args.checkpoint_every == 0 and idx + 1 < num_batches and writer:
+                writer.save(checkpoint_state(net, optimizer, epoch, idx + 1, world_size, sampler_state, fingerprint))
+            wait_start = time.time()
+
+        if writer:
+            # the next epoch's shuffle is drawn from the generator state as it is now
+            writer.save(checkpoint_state(net, optimizer, epoch + 1, 0, world_size,
+                                         None if distributed else shuffle_generator.get_state(), fingerprint))
+
+        # a large share of time waiting for input means loading, not compute, is the bottleneck
+        epoch_time = time.time() - epoch_start
+        if distributed:
+            totals = torch.tensor([float(samples)])
+            dist.all_reduce(totals)
+            samples = int(totals.item())
+        if rank == 0:
+            print('Epoch [{}/{}], Throughput: {:.1f} samples/sec, Input wait: {:.1f}% of {:.1f}s'.format(
+                epoch+1, num_epochs, samples / epoch_time, 100. * wait_time / epoch_time, epoch_time))
 
-    # Run model on test set in eval mode.
-    model.eval()
+    if writer:
+        writer.close()
+
+    # Run model on test set in eval mode. The unwrapped model is used, since
+    # the processes may evaluate a different number of batches.
+    net.eval()
     correct = 0
+    total = 0
     y_pred = []
     with torch.no_grad():
         for images, labels in test_loader:
             images = images.to(device)
             labels = labels.to(device)
-            outputs = model(images)
+            outputs = net(images)
             _, predicted = torch.max(outputs.data, 1)
             correct += predicted.eq(labels.data.view_as(predicted)).sum().item()
+            total += labels.shape[0]
             y_pred += predicted.tolist()
-        print('Test_set accuracy: ' + str(100. * correct / len(test_loader.dataset)) + '%')
+        if distributed:
+            totals = torch.tensor([float(correct), float(total)])
+            dist.all_reduce(totals)
+            correct, total = int(totals[0].item()), int(totals[1].item())
+        if rank == 0:
+            print('Test_set accuracy: ' + str(100. * correct / total) + '%')
     # convert y_pred to np array
     y_pred = np.array(y_pred)
 
     # Save the entire model to enable automated serving
-    torch.save(model.state_dict(), result_dir)
-    print("Model saved at " + result_dir)
+    if rank == 0:
+        torch.save(net.state_dict(), result_dir)
+        print("Model saved at " + result_dir)
+
+        if export_runtimes:
+            calibration = [torch.from_numpy(np.asarray(X_train[start:start + batch_size], dtype=np.float32))
+                           for start in range(0, min(len(X_train), 16 * batch_size), batch_size)]
+            report = export_all(net, result_dir, X_test, y_test, runtimes=export_runtimes,
+                                quantization=args.quantization, calibration=calibration, method=args.export_method)
+            for runtime, entry in report.items():
+                print('Export {}: {}'.format(runtime, json.dumps(entry)))
+
+        # the run is complete, so a later run with this checkpoint_dir starts afresh
+        remove_checkpoints(checkpoint_dir)
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
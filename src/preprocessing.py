@@ -16,22 +16,276 @@ import PIL
 from PIL import Image
 import numpy as np
 import argparse
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
 import time
 import os
 
 import pandas as pd
 
+from sharded_dataset import INDEX_FILENAME, truncate, update_rows, write_sharded
+
 np.random.seed(99)
 
+'''
+Incremental runs keep this manifest in result_dir. It records every
+processed image with its size and mtime, the labels parsed from its name,
+and its split and row in the output arrays, together with the settings the
+outputs were built with.
+'''
+MANIFEST_FILENAME = 'manifest.json'
+TEST_FRACTION = 0.3
+
+
+def parse_image_name(image_path):
+    """ UTKFace file names start with [age]_[gender]_[race]_. """
+    age, gender, race = image_path.split('/')[-1].split("_")[:3]
+    return int(age), int(gender), int(race)
+
+
+def decode_images(job):
+    """
+    Decode and resize one chunk of images straight into the shared uint8
+    memory map, starting at row start. Returns the rows that failed.
+    """
+    images_path, start, image_paths, img_size = job
+    images = np.load(images_path, mmap_mode='r+')
+    failed = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            images[start + i] = np.asarray(Image.open(image_path).convert('RGB').resize((img_size, img_size)))
+        except Exception:
+            print("Missing: " + image_path)
+            failed.append(start + i)
+    images.flush()
+    return failed
+
+
+def decode_all(image_paths, images_path, img_size, workers, chunk_size):
+    """
+    Decode the images in parallel into a preallocated uint8 memory map at
+    images_path instead of Python lists. Every worker writes its rows in
+    place, so memory stays bounded and the decode/resize work scales with the
+    number of workers. Returns the memory map and the rows that failed.
+    """
+    start_time = time.time()
+    np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8,
+                              shape=(len(image_paths), img_size, img_size, 3)).flush()
+    # a few chunks per worker so that slow chunks still keep every core busy
+    decode_size = max(1, min(chunk_size, -(-len(image_paths) // (workers * 4))))
+    jobs = [(images_path, start, image_paths[start:start + decode_size], img_size)
+            for start in range(0, len(image_paths), decode_size)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        failed = [row for rows in pool.imap_unordered(decode_images, jobs) for row in rows]
+    finally:
+        pool.close()
+        pool.join()
+    print("Decoded {} images with {} workers in {:.1f}s".format(len(image_paths), workers, time.time() - start_time))
+    return np.load(images_path, mmap_mode='r'), failed
+
+
+def gather_rows(images, ids):
+    """ NCHW copy of the given image rows, read in file order. """
+    order = np.argsort(ids)
+    rows = np.empty((len(ids),) + images.shape[1:], dtype=images.dtype)
+    rows[order] = images[ids[order]]
+    return rows.transpose(0, 3, 1, 2)
+
+
+def normalize(rows):
+    return 2.0 * rows.astype('float32') / 256.0 - 1.0
+
+
+def encode_rows(images, ids, output_format):
+    """ Image rows in the storage dtype of a sharded output format. """
+    if output_format == 'uint8':
+        return gather_rows(images, ids)
+    return normalize(gather_rows(images, ids)).astype(np.float16)
+
+
+def normalize_split(images, ids, path, chunk_size):
+    """
+    Write the normalized NCHW float32 array of the given image rows to path,
+    one chunk at a time, so that only chunk_size images are held in memory.
+    """
+    n, height, width, channels = (len(ids),) + images.shape[1:]
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, channels, height, width))
+    for start in range(0, n, chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+        out[start:start + len(chunk_ids)] = normalize(gather_rows(images, chunk_ids))
+    out.flush()
+
+
+def shard_split(images, ids, path, output_format, shard_size, append=False):
+    """
+    Write the given image rows as a sharded dataset in directory path. uint8
+    shards keep the raw pixels and are normalized when they are read; float16
+    shards hold the normalized values.
+    """
+    height, width, channels = images.shape[1:]
+    write_sharded(path, len(ids), lambda start, stop: encode_rows(images, ids[start:stop], output_format),
+                  (channels, height, width), encoding=output_format, rows_per_shard=shard_size, append=append)
+
+
+def split_of(name, test_fraction=TEST_FRACTION):
+    """ Deterministic per file, so an image stays in its split as the dataset grows. """
+    return 'test' if int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:8], 16) < test_fraction * 2 ** 32 else 'train'
+
+
+def process_all(image_paths, labels, result_dir, img_size, output_format, shard_size, workers, chunk_size):
+    """ Decode every image and write the randomly split train and test arrays. """
+    tmp_dir = tempfile.mkdtemp()
+    images, failed = decode_all(image_paths, os.path.join(tmp_dir, 'images.npy'), img_size, workers, chunk_size)
+
+    # images that could not be decoded are dropped along with their labels
+    valid = np.ones(len(image_paths), dtype=bool)
+    valid[failed] = False
+    rows = np.flatnonzero(valid)
+    labels = np.array(labels, dtype=np.int64).reshape(-1, 3)[rows]
+    outcome_gender_mat, protected_race_mat = labels[:, 1], labels[:, 2]
+
+    """ Split the dataset into train and test """
+
+    N = len(rows)
+    ids = np.random.permutation(N)
+    train_size=int(0.7 * N)
+    y_train = outcome_gender_mat[ids[0:train_size]]
+    y_test = outcome_gender_mat[ids[train_size:]]
+
+    p_train = protected_race_mat[ids[0:train_size]]
+    p_test = protected_race_mat[ids[train_size:]]
+
+    shutil.rmtree(result_dir, ignore_errors=True)
+    os.makedirs(result_dir)
+
+    # normalize and transpose to NCHW chunk by chunk, straight into the output files
+    if output_format == 'npy':
+        normalize_split(images, rows[ids[0:train_size]], result_dir + 'X_train.npy', chunk_size)
+        normalize_split(images, rows[ids[train_size:]], result_dir + 'X_test.npy', chunk_size)
+    else:
+        shard_split(images, rows[ids[0:train_size]], result_dir + 'X_train', output_format, shard_size)
+        shard_split(images, rows[ids[train_size:]], result_dir + 'X_test', output_format, shard_size)
+    del images
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    np.save(result_dir + 'y_train', y_train)
+    np.save(result_dir + 'y_test', y_test)
+    np.save(result_dir + 'p_train', p_train)
+    np.save(result_dir + 'p_test', p_test)
+
+
+def process_incremental(image_paths, labels, result_dir, settings, workers, chunk_size):
+    """
+    Only decode images that are not in the manifest yet, or whose size or
+    mtime changed. New images are appended to the shards of their split and
+    changed ones are rewritten in place, so the cost of a run is proportional
+    to the number of new or changed images. Everything is reprocessed when
+    the settings changed or images were removed.
+    """
+    img_size = settings['img_size']
+    output_format = settings['output_format']
+    manifest_path = result_dir + MANIFEST_FILENAME
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    names = [os.path.basename(image_path) for image_path in image_paths]
+    signatures = []
+    for image_path in image_paths:
+        stat = os.stat(image_path)
+        signatures.append({"size": stat.st_size, "mtime": stat.st_mtime})
+
+    if manifest is None or manifest['settings'] != settings or set(manifest['files']) - set(names):
+        if manifest is not None:
+            print("Settings changed or images were removed, reprocessing all images")
+        shutil.rmtree(result_dir, ignore_errors=True)
+        os.makedirs(result_dir)
+        manifest = {"version": 1, "settings": settings, "rows": {"train": 0, "test": 0}, "files": {}}
+    files = manifest['files']
+
+    # The manifest is written last, so a run that stopped early may have left
+    # rows in the shards that it does not record. Drop them; images whose
+    # rows were rewritten in place still look changed and are redone.
+    for split in ('train', 'test'):
+        if os.path.exists(os.path.join(result_dir + 'X_' + split, INDEX_FILENAME)):
+            truncate(result_dir + 'X_' + split, manifest['rows'][split])
+
+    new = sorted([i for i, name in enumerate(names) if name not in files], key=lambda i: names[i])
+    changed = [i for i, name in enumerate(names)
+               if name in files and (files[name]['size'], files[name]['mtime']) !=
+               (signatures[i]['size'], signatures[i]['mtime'])]
+    print("{} new and {} changed of {} images".format(len(new), len(changed), len(names)))
+
+    todo = new + changed
+    tmp_dir = tempfile.mkdtemp()
+    images, failed = decode_all([image_paths[i] for i in todo], os.path.join(tmp_dir, 'images.npy'),
+                                img_size, workers, chunk_size)
+    failed = set(todo[row] for row in failed)
+
+    for split in ('train', 'test'):
+        # rows of the decoded images, in the order of todo
+        appended = [k for k, i in enumerate(todo[:len(new)]) if i not in failed and split_of(names[i]) == split]
+        shard_split(images, np.array(appended, dtype=np.int64), result_dir + 'X_' + split, output_format,
+                    settings['shard_size'], append=True)
+        for k in appended:
+            i = todo[k]
+            age, gender, race = labels[i]
+            files[names[i]] = dict(signatures[i], age=age, gender=gender, race=race, split=split,
+                                   row=manifest['rows'][split])
+            manifest['rows'][split] += 1
+
+        updated = [k for k, i in enumerate(todo) if k >= len(new) and i not in failed
+                   and files[names[i]]['split'] == split]
+        if updated:
+            update_rows(result_dir + 'X_' + split, [files[names[todo[k]]]['row'] for k in updated],
+                        encode_rows(images, np.array(updated, dtype=np.int64), output_format))
+            for k in updated:
+                files[names[todo[k]]].update(signatures[todo[k]])
+    del images
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # the label arrays are small, so they are rebuilt from the manifest
+    for split in ('train', 'test'):
+        y = np.zeros(manifest['rows'][split], dtype=np.int64)
+        p = np.zeros(manifest['rows'][split], dtype=np.int64)
+        for entry in files.values():
+            if entry['split'] == split:
+                y[entry['row']] = entry['gender']
+                p[entry['row']] = entry['race']
+        np.save(result_dir + 'y_' + split, y)
+        np.save(result_dir + 'p_' + split, p)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, help='Dataset directory path')
     parser.add_argument('--result_dir', type=str, help='Processed data directory path')
+    parser.add_argument('--workers', type=int, help='Number of processes decoding images', default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk_size', type=int, help='Number of images normalized per step', default=1024)
+    parser.add_argument('--output_format', type=str, help='Feature array format: float32 .npy files, or shards of uint8 pixels or float16 values with a JSON index', choices=['npy', 'uint8', 'float16'], default="npy")
+    parser.add_argument('--shard_size', type=int, help='Number of images per shard', default=4096)
+    parser.add_argument('--incremental', action='store_true', help='Only process images that are new or changed since the last run, using a manifest in result_dir. Requires a sharded output format')
     args = parser.parse_args()
 
     image_dir = args.data_dir
     result_dir = args.result_dir
+    workers = args.workers
+    chunk_size = args.chunk_size
+    output_format = args.output_format
+    shard_size = args.shard_size
+    incremental = args.incremental
+    if incremental and output_format == 'npy':
+        parser.error('--incremental requires --output_format uint8 or float16')
 
     """ Load and Process Images """
 
@@ -43,60 +297,27 @@ if __name__ == "__main__":
 
     img_size = 64
 
-    protected_race = []
-    outcome_gender = []
-    feature_image = []
-    feature_age = []
+    image_paths = []
+    labels = []
 
     for i, image_path in enumerate(glob.glob(image_dir + "*.jpg")):
         try:
-            age, gender, race = image_path.split('/')[-1].split("_")[:3]
-            age = int(age)
-            gender = int(gender)
-            race = int(race)
+            age, gender, race = parse_image_name(image_path)
 
             if race in races_to_consider:
-                protected_race.append(race)
-                outcome_gender.append(gender)
-                feature_image.append(np.array(Image.open(image_path).resize((img_size, img_size))))
-                feature_age.append(age)
+                image_paths.append(image_path)
+                labels.append((age, gender, race))
         except:
             print("Missing: " + image_path)
 
-    feature_image_mat = np.array(feature_image)
-    outcome_gender_mat =  np.array(outcome_gender)
-    protected_race_mat =  np.array(protected_race)
-    age_mat = np.array(feature_age)
-
-    """ Split the dataset into train and test """
-
-    feature_image_mat_normed = 2.0 *feature_image_mat.astype('float32')/256.0 - 1.0
-
-    N = len(feature_image_mat_normed)
-    ids = np.random.permutation(N)
-    train_size=int(0.7 * N)
-    X_train = feature_image_mat_normed[ids[0:train_size]]
-    y_train = outcome_gender_mat[ids[0:train_size]]
-    X_test = feature_image_mat_normed[ids[train_size:]]
-    y_test = outcome_gender_mat[ids[train_size:]]
-
-    p_train = protected_race_mat[ids[0:train_size]]
-    p_test = protected_race_mat[ids[train_size:]]
-
-    age_train = age_mat[ids[0:train_size]]
-    age_test = age_mat[ids[train_size:]]
-
-    batch_size = 64
-
-    X_train = X_train.transpose(0,3,1,2)
-    X_test = X_test.transpose(0,3,1,2)
-
-    os.system('rm -r ' + result_dir)
-    os.system('mkdir ' + result_dir)
-
-    np.save(result_dir + 'X_train', X_train)
-    np.save(result_dir + 'X_test', X_test)
-    np.save(result_dir + 'y_train', y_train)
-    np.save(result_dir + 'y_test', y_test)
-    np.save(result_dir + 'p_train', p_train)
-    np.save(result_dir + 'p_test', p_test)
+    if incremental:
+        settings = {
+            "img_size": img_size,
+            "races_to_consider": races_to_consider,
+            "output_format": output_format,
+            "shard_size": shard_size,
+            "test_fraction": TEST_FRACTION
+        }
+        process_incremental(image_paths, labels, result_dir, settings, workers, chunk_size)
+    else:
+        process_all(image_paths, labels, result_dir, img_size, output_format, shard_size, workers, chunk_size)
@@ -11,83 +11,365 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
 # See the License for the specific language governing permissions and 
 # limitations under the License. 
+# taken first, so that the start-up timings include the imports
+import time
+started_at = time.time()
+
 import os
 import json
+import logging
+import threading
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from flask_cors import CORS
 
 import torch
-import numpy as np
-from torch.autograd import Variable
 from minio import Minio
+from minio.error import S3Error
 
-import zipfile
-import importlib
 import re
 
+import artifact_cache
+from batching import MicroBatcher
+import model_export
+import model_registry
+import tensor_codec
+
+logging.basicConfig(level="INFO", format='%(levelname)s: %(message)s')
+
+LOG = logging.getLogger("pytorch_serving")
+imported_at = time.time()
+
 
 """ Model prediction """
-class Model():
+'''
+The server hosts any number of models trained into the results bucket. Each
+is served at /models/<training_id>/predict and loaded on its first request.
+Loaded models stay resident in a ModelRegistry bounded by
+MODEL_REGISTRY_MAX_BYTES, which drops the least recently used ones beyond
+it, unless they are pinned.
+
+TRAINING_ID, if set, is pinned, loaded at start-up and also served at
+/predict. PINNED_MODELS is a comma separated list of more training ids to pin
+and load at start-up. WARMUP_INPUT_SHAPE, e.g. "1,3,64,64", runs a forward
+pass on zeros of that shape on every newly loaded model, WARMUP_ITERATIONS
+times, so that its first request does not pay for lazy initialization. A resident model is used for
+MODEL_REVALIDATE_SECONDS before the ETag of its weights is checked again.
+
+MODEL_RUNTIME picks what is served: eager (the default) runs the weights in
+the user's model class; torchscript, int8 and onnx run the artifacts exported
+next to them at training time (see model_export). The drift report of those
+artifacts against the fp32 model is served at /models/<training_id>/drift.
+'''
+class ModelHost():
     def __init__(self):
-        training_id = os.environ.get("TRAINING_ID")
+        self.bucket_name = os.environ.get("BUCKET_NAME")
+        self.model_file_name = os.environ.get("MODEL_FILE_NAME", "model.pt")
+        self.model_class_name = os.environ.get("MODEL_CLASS_NAME")
+        self.model_class_file = os.environ.get("MODEL_CLASS_FILE")
+        self.runtime = os.environ.get("MODEL_RUNTIME", "eager")
+        if self.runtime not in model_export.RUNTIMES:
+            raise ValueError('MODEL_RUNTIME must be one of ' + ', '.join(model_export.RUNTIMES))
+
+        self.connect()
+
+        self.registry = model_registry.ModelRegistry(
+            revalidate_seconds=float(os.environ.get('MODEL_REVALIDATE_SECONDS', 60)), on_drop=self._drop_batcher)
+        warmup_shape = os.environ.get('WARMUP_INPUT_SHAPE')
+        self.warmup_shape = tuple(int(dim) for dim in warmup_shape.split(',')) if warmup_shape else None
+        self.warmup_iterations = int(os.environ.get('WARMUP_ITERATIONS', 1))
+
+        '''
+        Requests for the same model are coalesced into a single forward pass
+        when MAX_BATCH_SIZE is greater than 1. MAX_BATCH_WAIT_MS bounds how
+        long the first request of a batch waits for others to arrive.
+        '''
+        self.max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', 1))
+        self.max_batch_wait_ms = float(os.environ.get('MAX_BATCH_WAIT_MS', 5))
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """ (Re)create the object storage client, e.g. in a forked worker, which must not share its connections. """
         endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL")
-        bucket_name = os.environ.get("BUCKET_NAME")
         bucket_key = os.environ.get("BUCKET_KEY")
         bucket_secret = os.environ.get("BUCKET_SECRET")
-        model_file_name = os.environ.get("MODEL_FILE_NAME")
-        model_class_name = os.environ.get("MODEL_CLASS_NAME")
-        model_class_file = os.environ.get("MODEL_CLASS_FILE")
-
-        # Define Object Storage resource and download the model file
 
+        # Define Object Storage resource
         url = re.compile(r"https?://")
-        cos = Minio(url.sub('', endpoint_url),
-                    access_key=bucket_key,
-                    secret_key=bucket_secret)
+        self.cos = Minio(url.sub('', endpoint_url),
+                         access_key=bucket_key,
+                         secret_key=bucket_secret)
 
-        KEY = training_id + '/' + model_file_name
+    def warm_up(self, model):
+        if self.warmup_shape:
+            with torch.no_grad():
+                for _ in range(self.warmup_iterations):
+                    model(torch.zeros(self.warmup_shape))
 
-        model_files = training_id + '/_submitted_code/model.zip'
-        cos.fget_object(bucket_name, KEY, 'model.pt')
-        cos.fget_object(bucket_name, model_files, 'model.zip')
+    def get_model(self, training_id):
+        """ The model of a training run, loaded (and warmed up) on first use. """
+        return self.registry.get(self.cos, self.bucket_name, training_id,
+                                 model_class_file=self.model_class_file, model_class_name=self.model_class_name,
+                                 weights_filename=self.model_file_name, warm_up=self.warm_up, runtime=self.runtime)
 
-        # Load PyTorch model definition from the source code.
-        zip_ref = zipfile.ZipFile('model.zip', 'r')
-        zip_ref.extractall('model_files')
-        zip_ref.close()
+    def drift_report(self, training_id):
+        """ The export report of a model: accuracy and drift of each runtime against fp32. """
+        path = artifact_cache.fetch(self.cos, self.bucket_name,
+                                    training_id + '/' + model_export.report_name(self.model_file_name))
+        with open(path) as f:
+            return json.load(f)
 
-        modulename = 'model_files.' + model_class_file.split('.')[0].replace('-', '_')
+    def load(self, training_id, pin=False):
+        if pin:
+            self.registry.pin(training_id)
+        self.get_model(training_id)
 
-        '''
-        We required users to define where the model class is located or follow
-        some naming convention we have provided.
-        '''
-        model_class = getattr(importlib.import_module(modulename), model_class_name)
+    def unload(self, training_id):
+        self.registry.unpin(training_id)
+        return self.registry.unload(training_id)
+
+    def forward(self, training_id, X):
+        model = self.get_model(training_id)
+        with torch.no_grad():
+            return model(X)
+
+    def _batcher(self, training_id):
+        with self._lock:
+            if training_id not in self._batchers:
+                self._batchers[training_id] = MicroBatcher(lambda X: self.forward(training_id, X),
+                                                           max_batch_size=self.max_batch_size,
+                                                           max_wait_ms=self.max_batch_wait_ms)
+            return self._batchers[training_id]
 
-        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-        self.model = model_class().to(device)
-        self.model.load_state_dict(torch.load('model.pt', map_location=device))
-        self.model.eval()
+    def _drop_batcher(self, training_id):
+        # the registry dropped the model, so its batcher and thread go too
+        with self._lock:
+            batcher = self._batchers.pop(training_id, None)
+        if batcher is not None:
+            batcher.close()
 
-    def predict(self, X):
-        return self.model(torch.FloatTensor(X)).tolist()
+    def predict(self, training_id, inputs):
+        if self.max_batch_size <= 1:
+            return self.forward(training_id, inputs)
+        # load the model first, so that unknown training ids never get a batcher
+        self.get_model(training_id)
+        return self._batcher(training_id).submit(inputs)
+
+    def batching_stats(self):
+        with self._lock:
+            batchers = dict(self._batchers)
+        return {training_id: batcher.stats() for training_id, batcher in batchers.items()}
+
+
+class Startup():
+    """
+    Loads the start-up models and tracks the state reported by /healthz and
+    /ready: "loading" until every start-up model is fetched, loaded and
+    warmed up, then "ready", or "failed" if one of them could not be loaded.
+    The artifacts of all start-up models are prefetched concurrently before
+    the models are loaded one by one.
+    """
+    def __init__(self, host, training_ids):
+        self.host = host
+        self.training_ids = training_ids
+        self.state = 'loading' if training_ids else 'ready'
+        self.error = None
+        self.timings = {"imports_ms": (imported_at - started_at) * 1000.0}
+        for training_id in training_ids:
+            host.registry.pin(training_id)
+
+    def run(self):
+        try:
+            started = time.time()
+            host = self.host
+            artifact_cache.fetch_all(host.cos, [
+                (host.bucket_name, name) for training_id in self.training_ids
+                for name in model_registry.model_objects(training_id, host.model_file_name, host.runtime)])
+            self.timings["prefetch_ms"] = (time.time() - started) * 1000.0
+            LOG.info('Prefetched %d models in %.0f ms' % (len(self.training_ids), self.timings["prefetch_ms"]))
+            for training_id in self.training_ids:
+                self.host.load(training_id)
+                for entry in self.host.registry.stats()["models"]:
+                    if entry["model_id"] == training_id:
+                        self.timings[training_id] = entry["timings"]
+                        LOG.info('Loaded %s: %s' % (training_id, ', '.join(
+                            '%s %.0f' % (phase, ms) for phase, ms in sorted(entry["timings"].items()))))
+                if self.host.runtime != 'eager':
+                    self.log_drift(training_id)
+        except Exception as e:
+            LOG.exception('Loading the start-up models failed')
+            self.error = '%s: %s' % (e.__class__.__name__, str(e))
+            self.state = 'failed'
+            return
+        self.timings["ready_ms"] = (time.time() - started_at) * 1000.0
+        self.state = 'ready'
+        LOG.info('Ready %.0f ms after start' % self.timings["ready_ms"])
+
+    def log_drift(self, training_id):
+        try:
+            report = self.host.drift_report(training_id)
+        except S3Error as e:
+            LOG.warning('No export report for %s: %s' % (training_id, e.code))
+            return
+        LOG.info('%s %s drift against fp32: %s' % (training_id, self.host.runtime,
+                                                   json.dumps(report.get(self.host.runtime))))
+
+    def status(self):
+        status = {"state": self.state, "timings": self.timings}
+        if self.error:
+            status["error"] = self.error
+        return status
 
 
 app = Flask(__name__)
 CORS(app)
-model = Model()
+host = ModelHost()
+default_training_id = os.environ.get("TRAINING_ID")
+startup = Startup(host, [training_id.strip() for training_id in
+                         [default_training_id or ""] + os.environ.get("PINNED_MODELS", "").split(',')
+                         if training_id.strip()])
+
+'''
+With STARTUP_LOAD=background (the default) the server binds at once and the
+start-up models load in a background thread, so that scale-from-zero
+requests are accepted right away; predictions for a model that is still
+loading wait for it. STARTUP_LOAD=blocking loads them before binding.
+
+WORKERS > 0 serves from that many pre-forked gunicorn worker processes
+instead of the Flask development server. The start-up models are then
+loaded before forking and their weights moved to shared memory, so the
+workers share one copy of them; no thread may run in the process that
+forks. Each worker handles WORKER_THREADS requests at a time and limits
+torch to THREADS_PER_WORKER intra-op threads, by default the cores divided
+among the workers. Models a worker loads later are its own.
+'''
+workers = int(os.environ.get('WORKERS', 0))
+if workers or os.environ.get('STARTUP_LOAD', 'background') == 'blocking':
+    startup.run()
+    if startup.state == 'failed':
+        raise RuntimeError(startup.error)
+    if workers:
+        host.registry.share_memory()
+else:
+    loader = threading.Thread(target=startup.run, name='startup-loader')
+    loader.daemon = True
+    loader.start()
+
+
+def is_missing(e):
+    return isinstance(e, S3Error) and e.code in ('NoSuchKey', 'NoSuchObject')
 
 
 """ API methods. """
-@app.route('/predict', methods=['POST'])
-def serving_api():
+def predict_response(training_id):
+    """
+    Inputs are a JSON list by default. Clients can instead post raw float32,
+    .npy or Arrow tensor bytes (see tensor_codec), and get the predictions back
+    in the same format or in the one named by the Accept header.
+    """
+    input_format = tensor_codec.request_format(request)
     try:
-        inputs = request.json['inputs']
-        global model
+        if input_format == tensor_codec.JSON:
+            inputs = torch.tensor(request.json['inputs'], dtype=torch.float32)
+        else:
+            inputs = tensor_codec.decode(request.get_data(), input_format, request.headers)
     except:
         abort(400)
-    return json.dumps({"predictions": model.predict(inputs)})
+    # predictions are made per row, so a scalar is not a valid request
+    if inputs.dim() < 1:
+        abort(400)
+
+    try:
+        outputs = host.predict(training_id, inputs)
+    except S3Error as e:
+        if is_missing(e):
+            abort(404)
+        raise
+
+    output_format = tensor_codec.response_format(request, input_format)
+    if output_format == tensor_codec.JSON:
+        return json.dumps({"predictions": outputs.tolist()})
+    body, headers = tensor_codec.encode(outputs.numpy(), output_format)
+    return Response(body, mimetype=output_format, headers=headers)
+
+
+@app.route('/predict', methods=['POST'])
+def serving_api():
+    if not default_training_id:
+        abort(404)
+    return predict_response(default_training_id)
+
+
+@app.route('/models/<training_id>/predict', methods=['POST'])
+def model_serving_api(training_id):
+    return predict_response(training_id)
+
+
+@app.route('/models', methods=['GET'])
+def models_api():
+    """ Resident and pinned models, and the registry's hit, load and eviction counts. """
+    return json.dumps(host.registry.stats())
+
+
+@app.route('/models/<training_id>/drift', methods=['GET'])
+def drift_api(training_id):
+    """ Accuracy drift of the exported artifacts against the fp32 model, with the runtime being served. """
+    try:
+        report = host.drift_report(training_id)
+    except S3Error as e:
+        if is_missing(e):
+            abort(404)
+        raise
+    return json.dumps({"training_id": training_id, "runtime": host.runtime, "report": report})
+
+
+@app.route('/models/<training_id>', methods=['PUT'])
+def load_model_api(training_id):
+    """ Load and warm up a model ahead of its first request; ?pin=true keeps it resident. """
+    try:
+        host.load(training_id, pin=request.args.get('pin', 'false').lower() == 'true')
+    except S3Error as e:
+        if is_missing(e):
+            abort(404)
+        raise
+    return json.dumps({"training_id": training_id, "status": "loaded"})
+
+
+@app.route('/models/<training_id>', methods=['DELETE'])
+def unload_model_api(training_id):
+    """ Unpin a model and free its memory; it is loaded again on its next request. """
+    unloaded = host.unload(training_id)
+    return json.dumps({"training_id": training_id, "status": "unloaded" if unloaded else "not loaded"})
+
+
+@app.route('/stats', methods=['GET'])
+def serving_stats():
+    """
+    Micro-batching statistics of the model served at /predict, with those of
+    every model under "models".
+    """
+    if host.max_batch_size <= 1:
+        return json.dumps({"batching": False})
+    models = host.batching_stats()
+    stats = dict(models.get(default_training_id, {}))
+    stats["batching"] = True
+    stats["models"] = models
+    return json.dumps(stats)
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """ Liveness: fails only once loading the start-up models has failed. """
+    return Response(json.dumps(startup.status()), status=500 if startup.state == 'failed' else 200,
+                    mimetype=tensor_codec.JSON)
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """ Readiness: succeeds once the start-up models are loaded and warmed up. """
+    return Response(json.dumps(startup.status()), status=200 if startup.state == 'ready' else 503,
+                    mimetype=tensor_codec.JSON)
 
 
 @app.route('/predict', methods=['OPTIONS'])
@@ -95,5 +377,49 @@ def serving_api_options():
     return "200"
 
 
+@app.route('/models/<training_id>/predict', methods=['OPTIONS'])
+def model_serving_api_options(training_id):
+    return "200"
+
+
+def serve_production(app, workers, port):
+    """ Serve app from pre-forked gunicorn workers, which share the memory of everything loaded so far. """
+    from gunicorn.app.base import BaseApplication
+
+    threads_per_worker = int(os.environ.get('THREADS_PER_WORKER', 0)) or max(1, (os.cpu_count() or 1) // workers)
+
+    def post_fork(server, worker):
+        # otherwise every worker starts one torch thread per core
+        torch.set_num_threads(threads_per_worker)
+        # the client of the master holds a connection pool the workers must not share
+        host.connect()
+
+    options = {
+        "bind": '0.0.0.0:%d' % port,
+        "workers": workers,
+        "worker_class": 'gthread',
+        "threads": int(os.environ.get('WORKER_THREADS', 4)),
+        "timeout": int(os.environ.get('WORKER_TIMEOUT', 120)),
+        "post_fork": post_fork
+    }
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    LOG.info('Starting %d workers with %d torch threads each' % (workers, threads_per_worker))
+    Server().run()
+
+
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    port = int(os.environ.get('PORT', 8080))
+    LOG.info('Binding %.0f ms after start' % ((time.time() - started_at) * 1000.0))
+    if workers:
+        serve_production(app, workers, port)
+    else:
+        # the reloader would import the app twice and load the start-up models in both
+        app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,165 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Request coalescing for the /predict endpoint. """
+import threading
+import time
+import queue
+
+import torch
+
+# queued by close, after the last request the worker serves
+_CLOSE = object()
+
+
+class _PendingRequest():
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.rows = inputs.shape[0]
+        self.enqueued_at = time.time()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class MicroBatcher():
+    """
+    Collects concurrent prediction requests into a single tensor and runs one
+    forward pass for all of them. A batch is dispatched as soon as it holds
+    max_batch_size rows or the oldest request has waited max_wait_ms.
+    Every caller gets back only the rows that belong to its own request.
+    close stops the worker thread once the requests queued so far are served.
+    """
+    def __init__(self, forward_fn, max_batch_size=32, max_wait_ms=5):
+        self.forward_fn = forward_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._carry = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            "requests": 0,
+            "rows": 0,
+            "batches": 0,
+            "max_queue_depth": 0,
+            "max_batch_rows": 0,
+            "total_wait_ms": 0.0,
+            "total_forward_ms": 0.0,
+            "batch_size_histogram": {}
+        }
+        self._worker = threading.Thread(target=self._run, name='micro-batcher')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, inputs):
+        """ Queue one request and block until its slice of the batch output is ready. """
+        pending = _PendingRequest(inputs)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(pending)
+                self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+        if closed:
+            # a request racing with close is served on its own
+            return self.forward_fn(inputs)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.outputs
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_CLOSE)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["batch_size_histogram"] = dict(self._stats["batch_size_histogram"])
+        stats["queue_depth"] = self._queue.qsize()
+        stats["max_batch_size"] = self.max_batch_size
+        stats["max_wait_ms"] = self.max_wait * 1000.0
+        if stats["batches"]:
+            stats["mean_batch_rows"] = float(stats["rows"]) / stats["batches"]
+            stats["mean_forward_ms"] = stats["total_forward_ms"] / stats["batches"]
+        if stats["requests"]:
+            stats["mean_wait_ms"] = stats["total_wait_ms"] / stats["requests"]
+        return stats
+
+    def _next_request(self, timeout=None):
+        if self._carry is not None:
+            pending, self._carry = self._carry, None
+            return pending
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        # Block for the first request, then keep pulling requests with the same
+        # sample shape until the batch is full or the wait budget is spent.
+        first = self._next_request()
+        if first is _CLOSE:
+            return None, 0
+        batch = [first]
+        rows = first.rows
+        deadline = first.enqueued_at + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if (pending is _CLOSE or pending.inputs.shape[1:] != first.inputs.shape[1:]
+                    or rows + pending.rows > self.max_batch_size):
+                self._carry = pending
+                break
+            batch.append(pending)
+            rows += pending.rows
+        return batch, rows
+
+    def _run(self):
+        while True:
+            batch, rows = self._collect()
+            if batch is None:
+                return
+            started = time.time()
+            try:
+                if len(batch) == 1:
+                    inputs = batch[0].inputs
+                else:
+                    inputs = torch.cat([pending.inputs for pending in batch], dim=0)
+                outputs = self.forward_fn(inputs)
+                offset = 0
+                for pending in batch:
+                    pending.outputs = outputs[offset:offset + pending.rows]
+                    offset += pending.rows
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finished = time.time()
+
+            with self._lock:
+                self._stats["requests"] += len(batch)
+                self._stats["rows"] += rows
+                self._stats["batches"] += 1
+                self._stats["max_batch_rows"] = max(self._stats["max_batch_rows"], rows)
+                self._stats["total_wait_ms"] += sum(started - pending.enqueued_at for pending in batch) * 1000.0
+                self._stats["total_forward_ms"] += (finished - started) * 1000.0
+                histogram = self._stats["batch_size_histogram"]
+                histogram[rows] = histogram.get(rows, 0) + 1
+
+            for pending in batch:
+                pending.done.set()
@@ -0,0 +1,117 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Binary tensor payloads for the /predict endpoint. """
+import io
+
+import numpy as np
+import torch
+
+JSON = 'application/json'
+RAW = 'application/octet-stream'
+NPY = 'application/x-npy'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+SUPPORTED_FORMATS = (JSON, RAW, NPY, ARROW)
+
+'''
+Raw payloads are little-endian float32 values in C order. Their shape is sent
+in this header as comma separated dimensions, e.g. "8,3,64,64".
+'''
+SHAPE_HEADER = 'X-Tensor-Shape'
+
+
+def _media_type(value):
+    return value.split(';')[0].strip().lower() if value else ''
+
+
+def request_format(request):
+    """ Format of the request body, JSON when the content type is unknown. """
+    content_type = _media_type(request.headers.get('Content-Type'))
+    if content_type in SUPPORTED_FORMATS:
+        return content_type
+    return JSON
+
+
+def response_format(request, input_format):
+    """ Reply in the first supported type the client accepts, or in the request format. """
+    for accepted in request.headers.get('Accept', '').split(','):
+        accepted = _media_type(accepted)
+        if accepted in SUPPORTED_FORMATS:
+            return accepted
+    return input_format
+
+
+def _as_tensor(array):
+    if array.dtype != np.float32:
+        array = array.astype(np.float32)
+    # Arrays over the request body are read-only, as the body is immutable
+    # bytes. Models may modify their inputs in place, so those are copied.
+    if not array.flags.writeable:
+        array = array.copy()
+    return torch.from_numpy(array)
+
+
+def _decode_npy(data):
+    stream = io.BytesIO(data)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    count = int(np.prod(shape)) if shape else 1
+    array = np.frombuffer(data, dtype=dtype, count=count, offset=stream.tell())
+    if fortran_order:
+        return np.ascontiguousarray(array.reshape(shape[::-1]).transpose())
+    return array.reshape(shape)
+
+
+def _decode_arrow(data):
+    import pyarrow as pa
+
+    return pa.ipc.read_tensor(pa.BufferReader(data)).to_numpy()
+
+
+def decode(data, input_format, headers):
+    """ Turn a binary request body into a float32 tensor, copying the payload once at most. """
+    if input_format == RAW:
+        shape = tuple(int(dim) for dim in headers[SHAPE_HEADER].split(','))
+        array = np.frombuffer(data, dtype='<f4').reshape(shape)
+    elif input_format == NPY:
+        array = _decode_npy(data)
+    elif input_format == ARROW:
+        array = _decode_arrow(data)
+    else:
+        raise ValueError('Unsupported tensor format: ' + input_format)
+    return _as_tensor(array)
+
+
+def encode(array, output_format):
+    """ Serialize a numpy array, returning the response body and extra headers. """
+    headers = {}
+    if output_format == RAW:
+        body = np.ascontiguousarray(array, dtype='<f4').tobytes()
+        headers[SHAPE_HEADER] = ','.join(str(dim) for dim in array.shape)
+    elif output_format == NPY:
+        stream = io.BytesIO()
+        np.save(stream, array, allow_pickle=False)
+        body = stream.getvalue()
+    elif output_format == ARROW:
+        import pyarrow as pa
+
+        sink = pa.BufferOutputStream()
+        pa.ipc.write_tensor(pa.Tensor.from_numpy(np.ascontiguousarray(array)), sink)
+        body = sink.getvalue().to_pybytes()
+    else:
+        raise ValueError('Unsupported tensor format: ' + output_format)
+    return body, headers
@@ -0,0 +1,89 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Eviction and locking of the artifact cache. """
+import hashlib
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from artifact_cache import ArtifactCache  # noqa: E402
+
+
+class Stat():
+    def __init__(self, data):
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.size = len(data)
+
+
+class FakeClient():
+    """ The stat_object and fget_object calls of a Minio client, over a dict of objects. """
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+
+    def stat_object(self, bucket, object_name):
+        return Stat(self.objects[(bucket, object_name)])
+
+    def fget_object(self, bucket, object_name, path):
+        self.downloads += 1
+        with open(path, 'wb') as f:
+            f.write(self.objects[(bucket, object_name)])
+
+
+def objects(n, size=100):
+    return {('bucket', 'object-%d' % i): bytes([i]) * size for i in range(n)}
+
+
+def test_fetched_paths_are_never_evicted_while_pinned(tmp_path):
+    client = FakeClient(objects(10))
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=250)
+    paths = cache.fetch_all(client, sorted(client.objects))
+    # the working set is four times max_bytes, yet every path is still there
+    for path, obj in zip(paths, sorted(client.objects)):
+        with open(path, 'rb') as f:
+            assert f.read() == client.objects[obj]
+
+
+def test_least_recently_used_entries_make_room_before_a_download(tmp_path):
+    client = FakeClient(objects(4))
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=250, pin_seconds=0)
+    first, second, third = [cache.fetch(client, 'bucket', 'object-%d' % i) for i in range(3)]
+    assert not os.path.exists(first)
+    assert os.path.exists(second) and os.path.exists(third)
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in os.listdir(str(tmp_path))) <= 250
+
+
+def test_cached_objects_are_not_downloaded_again(tmp_path):
+    client = FakeClient(objects(2))
+    cache = ArtifactCache(cache_dir=str(tmp_path))
+    assert cache.fetch(client, 'bucket', 'object-0') == cache.fetch(client, 'bucket', 'object-0')
+    assert client.downloads == 1
+    client.objects[('bucket', 'object-0')] = b'changed'
+    with open(cache.fetch(client, 'bucket', 'object-0'), 'rb') as f:
+        assert f.read() == b'changed'
+    assert client.downloads == 2
+
+
+def test_key_locks_are_dropped_after_fetching(tmp_path):
+    client = FakeClient(objects(5))
+    cache = ArtifactCache(cache_dir=str(tmp_path))
+    threads = [threading.Thread(target=cache.fetch_all, args=(client, sorted(client.objects))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert client.downloads == 5
+    assert cache._key_locks == {}
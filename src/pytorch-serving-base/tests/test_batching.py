@@ -0,0 +1,117 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Coalescing, slicing and shutdown of the micro-batcher. """
+import os
+import sys
+import threading
+import time
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from batching import MicroBatcher  # noqa: E402
+
+
+class Recorder():
+    """ A forward function that doubles its inputs and records the batches it saw. """
+    def __init__(self, release=None):
+        self.release = release
+        self.entered = threading.Event()
+        self.batches = []
+
+    def __call__(self, X):
+        self.entered.set()
+        if self.release is not None:
+            self.release.wait()
+        self.batches.append(X.shape[0])
+        return X * 2
+
+
+def submit_all(batcher, requests):
+    results = [None] * len(requests)
+    start = threading.Barrier(len(requests))
+
+    def submit(i):
+        start.wait()
+        results[i] = batcher.submit(requests[i])
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_get_their_own_rows():
+    forward = Recorder()
+    batcher = MicroBatcher(forward, max_batch_size=16, max_wait_ms=200)
+    requests = [torch.full((rows, 3), float(i)) for i, rows in enumerate([1, 2, 3, 4, 1, 2])]
+    results = submit_all(batcher, requests)
+    for inputs, outputs in zip(requests, results):
+        assert torch.equal(outputs, inputs * 2)
+    assert sum(forward.batches) == 13
+    assert len(forward.batches) < len(requests)
+    assert max(forward.batches) <= 16
+    batcher.close()
+
+
+def test_requests_of_different_shapes_are_not_mixed():
+    forward = Recorder()
+    batcher = MicroBatcher(forward, max_batch_size=16, max_wait_ms=100)
+    requests = [torch.ones(2, 3), torch.ones(2, 5), torch.ones(1, 3), torch.ones(1, 5)]
+    results = submit_all(batcher, requests)
+    for inputs, outputs in zip(requests, results):
+        assert torch.equal(outputs, inputs * 2)
+    batcher.close()
+
+
+def test_errors_reach_every_request_of_the_batch():
+    def fail(X):
+        raise RuntimeError('forward failed')
+
+    batcher = MicroBatcher(fail, max_batch_size=4, max_wait_ms=1)
+    with pytest.raises(RuntimeError):
+        batcher.submit(torch.ones(1, 3))
+    batcher.close()
+
+
+def test_close_serves_queued_requests_then_stops():
+    release = threading.Event()
+    forward = Recorder(release)
+    batcher = MicroBatcher(forward, max_batch_size=4, max_wait_ms=0)
+    results = []
+
+    def submit():
+        results.append(batcher.submit(torch.ones(1, 3)))
+
+    # the first request holds the worker in its forward pass while the second is queued
+    first, second = threading.Thread(target=submit), threading.Thread(target=submit)
+    first.start()
+    forward.entered.wait()
+    second.start()
+    while batcher._queue.qsize() < 1:
+        time.sleep(0.001)
+    batcher.close()
+    release.set()
+    first.join()
+    second.join()
+    batcher._worker.join(5)
+    assert not batcher._worker.is_alive()
+    assert len(results) == 2 and forward.batches == [1, 1]
+    # a request after close is served without the worker
+    assert torch.equal(batcher.submit(torch.ones(1, 3)), torch.ones(1, 3) * 2)
+    batcher.close()
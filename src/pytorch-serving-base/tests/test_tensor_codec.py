@@ -0,0 +1,77 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Round trips of the binary tensor formats. """
+import importlib.util
+import io
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tensor_codec  # noqa: E402
+
+BINARY_FORMATS = [tensor_codec.RAW, tensor_codec.NPY,
+                  pytest.param(tensor_codec.ARROW, marks=pytest.mark.skipif(
+                      importlib.util.find_spec('pyarrow') is None, reason='pyarrow is not installed'))]
+
+
+def images(dtype=np.float32):
+    return np.random.RandomState(0).uniform(0, 255, (2, 3, 4, 5)).astype(dtype)
+
+
+def round_trip(array, output_format):
+    body, headers = tensor_codec.encode(array, output_format)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        return tensor_codec.decode(body, output_format, headers), body
+
+
+@pytest.mark.parametrize('output_format', BINARY_FORMATS)
+def test_round_trip(output_format):
+    array = images()
+    tensor, _ = round_trip(array, output_format)
+    assert tensor.dtype == torch.float32
+    np.testing.assert_array_equal(tensor.numpy(), array)
+
+
+@pytest.mark.parametrize('output_format', BINARY_FORMATS)
+def test_decoded_tensor_can_be_modified_in_place(output_format):
+    array = images()
+    tensor, body = round_trip(array, output_format)
+    before = bytearray(body)
+    tensor.mul_(2)
+    np.testing.assert_array_equal(tensor.numpy(), array * 2)
+    assert body == before
+
+
+def test_npy_of_other_dtypes_and_orders_decodes_to_float32():
+    array = images(np.float64)
+    for stored in (array, np.asfortranarray(array), array.astype('>f4'), array.astype(np.uint8)):
+        stream = io.BytesIO()
+        np.save(stream, stored)
+        tensor = tensor_codec.decode(stream.getvalue(), tensor_codec.NPY, {})
+        assert tensor.dtype == torch.float32
+        np.testing.assert_array_equal(tensor.numpy(), stored.astype(np.float32))
+
+
+def test_raw_shape_header():
+    body, headers = tensor_codec.encode(images(), tensor_codec.RAW)
+    assert headers == {tensor_codec.SHAPE_HEADER: '2,3,4,5'}
+    with pytest.raises(ValueError):
+        tensor_codec.decode(body, tensor_codec.RAW, {tensor_codec.SHAPE_HEADER: '2,3,4,4'})
@@ -0,0 +1,82 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Incremental preprocessing, including recovery from a run that stopped early. """
+import glob
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+Image = pytest.importorskip('PIL.Image')
+
+import preprocessing  # noqa: E402
+from sharded_dataset import load_array  # noqa: E402
+
+SETTINGS = {"img_size": 64, "races_to_consider": [0, 4], "output_format": "uint8",
+            "shard_size": 4, "test_fraction": 0.3}
+
+
+def add_images(images_dir, count, rng):
+    for _ in range(count):
+        n = len(os.listdir(images_dir))
+        # <age>_<gender>_<race>_<date>.jpg, as in UTKFace
+        name = '%d_%d_%d_%d.jpg' % (20 + n % 30, n % 2, [0, 4][n % 2], n)
+        pixels = rng.randint(0, 255, (70, 70, 3)).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(images_dir, name))
+
+
+def run(images_dir, result_dir):
+    image_paths = sorted(glob.glob(os.path.join(images_dir, '*.jpg')))
+    labels = [preprocessing.parse_image_name(path) for path in image_paths]
+    preprocessing.process_incremental(image_paths, labels, result_dir, dict(SETTINGS), 1, 8)
+
+
+def assert_same_output(result_dir, reference_dir):
+    for split in ('train', 'test'):
+        np.testing.assert_array_equal(np.asarray(load_array(result_dir, 'X_' + split)),
+                                      np.asarray(load_array(reference_dir, 'X_' + split)))
+        for name in ('y_', 'p_'):
+            np.testing.assert_array_equal(np.load(result_dir + name + split + '.npy'),
+                                          np.load(reference_dir + name + split + '.npy'))
+
+
+def test_run_stopped_before_the_manifest_is_redone(tmp_path, monkeypatch):
+    images_dir = str(tmp_path / 'images')
+    result_dir = str(tmp_path / 'result') + '/'
+    reference_dir = str(tmp_path / 'reference') + '/'
+    os.makedirs(images_dir)
+    rng = np.random.RandomState(0)
+    add_images(images_dir, 7, rng)
+    run(images_dir, result_dir)
+    add_images(images_dir, 9, rng)
+
+    replace = os.replace
+
+    def stop_before_manifest(src, dst):
+        if dst.endswith(preprocessing.MANIFEST_FILENAME):
+            raise KeyboardInterrupt
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', stop_before_manifest)
+    with pytest.raises(KeyboardInterrupt):
+        run(images_dir, result_dir)
+    monkeypatch.undo()
+
+    run(images_dir, result_dir)
+    run(images_dir, reference_dir)
+    assert_same_output(result_dir, reference_dir)
+    assert not [name for name in os.listdir(result_dir + 'X_train') if name.endswith('.tmp')]
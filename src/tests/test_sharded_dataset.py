@@ -0,0 +1,91 @@
+# Copyright 2019 IBM Corporation 
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); 
+# you may not use this file except in compliance with the License. 
+# You may obtain a copy of the License at 
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0 
+# 
+# Unless required by applicable law or agreed to in writing, software 
+# distributed under the License is distributed on an "AS IS" BASIS, 
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. 
+# See the License for the specific language governing permissions and 
+# limitations under the License. 
+""" Writing, appending to, updating and truncating sharded datasets. """
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sharded_dataset import open_sharded, read_index, truncate, update_rows, write_sharded  # noqa: E402
+
+ROW_SHAPE = (3, 2, 2)
+
+
+def pixels(n, seed=0):
+    return np.random.RandomState(seed).randint(0, 256, (n,) + ROW_SHAPE).astype(np.uint8)
+
+
+def write(path, rows, append=False, rows_per_shard=4):
+    return write_sharded(path, len(rows), lambda start, stop: rows[start:stop], ROW_SHAPE,
+                         rows_per_shard=rows_per_shard, append=append)
+
+
+def stored(path):
+    """ The rows of the dataset in storage dtype, read through the checksummed index. """
+    data = open_sharded(os.path.join(path, 'index.json'))
+    return np.round((data[:] - data.offset) / data.scale).astype(np.uint8)
+
+
+def test_appended_rows_top_up_the_last_shard(tmp_path):
+    path = str(tmp_path / 'X')
+    rows = pixels(11)
+    write(path, rows[:6])
+    index = write(path, rows[6:], append=True)
+    assert [(shard['start'], shard['stop']) for shard in index['shards']] == [(0, 4), (4, 8), (8, 11)]
+    np.testing.assert_array_equal(stored(path), rows)
+
+
+def test_update_rows_rewrites_only_the_given_rows(tmp_path):
+    path = str(tmp_path / 'X')
+    rows = pixels(10)
+    write(path, rows)
+    first_shard = read_index(path)['shards'][0]['sha256']
+    update_rows(path, [5, 9], pixels(2, seed=1))
+    rows[[5, 9]] = pixels(2, seed=1)
+    np.testing.assert_array_equal(stored(path), rows)
+    assert read_index(path)['shards'][0]['sha256'] == first_shard
+
+
+def test_truncate_drops_later_rows_and_stray_files(tmp_path):
+    path = str(tmp_path / 'X')
+    rows = pixels(10)
+    write(path, rows)
+    # leftovers of interrupted writes: a temporary shard and a shard the index never recorded
+    for name in ('shard-00000.npy.tmp', 'index.json.tmp', 'shard-00003.npy'):
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(b'partial')
+    index = truncate(path, 8)
+    assert index['shape'][0] == 8
+    assert sorted(os.listdir(path)) == ['index.json', 'shard-00000.npy', 'shard-00001.npy']
+    np.testing.assert_array_equal(stored(path), rows[:8])
+
+
+def test_truncate_cuts_a_shard_topped_up_before_the_index_was_written(tmp_path):
+    path = str(tmp_path / 'X')
+    rows = pixels(7)
+    write(path, rows[:6])
+    # an append that rewrote the last shard and then stopped
+    np.save(os.path.join(path, 'shard-00001.npy'), rows[4:7])
+    truncate(path, 6)
+    np.testing.assert_array_equal(stored(path), rows[:6])
+
+
+def test_truncate_never_adds_rows(tmp_path):
+    path = str(tmp_path / 'X')
+    write(path, pixels(5))
+    with pytest.raises(ValueError):
+        truncate(path, 6)